@@ -4,14 +4,20 @@ RSS-новости удалены — новости теперь через New
 """
 import asyncio
 import logging
+import random
 import time
 from datetime import datetime, timezone
 from typing import Optional, Dict, Any, Callable
-from functools import wraps
-from dataclasses import dataclass
+from functools import lru_cache, wraps
+from dataclasses import dataclass, field
 
 import aiohttp
 
+try:
+    import orjson
+except ImportError:  # необязательная зависимость — откат на stdlib json
+    orjson = None
+
 from config import (
     OPEN_METEO_BASE, COINGECKO_URL, COINGECKO_PARAMS, EXCHANGE_RATE_URL
 )
@@ -24,30 +30,70 @@ RETRY_DELAY_BASE = 1.0
 RETRY_DELAY_MAX = 10.0
 
 WEATHER_HOURLY_LIMIT = 10
+WEATHER_REFILL_RATE = WEATHER_HOURLY_LIMIT / 3600.0  # токенов в секунду
+WEATHER_ACQUIRE_MAX_WAIT = 30.0  # максимум ожидания свободного токена
+
+# Неизменная часть параметров Open-Meteo — собираем один раз
+_WEATHER_CURRENT = "temperature_2m,relative_humidity_2m,weather_code,cloud_cover,precipitation"
+_WEATHER_TZ = "auto"
 
 
 @dataclass
 class WeatherMetrics:
-    hourly_calls: int = 0
-    last_hour_reset: float = 0
+    """Token bucket вместо фиксированного окна в час.
+
+    Старая схема разрешала залп из 10 запросов в начале каждого часа и
+    отбивала всех остальных до сброса. Бакет пополняется непрерывно
+    (10/3600 токена в секунду), поэтому запросы распределяются равномерно.
+    """
+    tokens: float = WEATHER_HOURLY_LIMIT
+    last_refill: float = field(default_factory=time.monotonic)
+    capacity: int = WEATHER_HOURLY_LIMIT
+    rate: float = WEATHER_REFILL_RATE
+    _lock: asyncio.Lock = field(default_factory=asyncio.Lock, repr=False)
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def try_consume(self) -> bool:
+        """Атомарно (в рамках одного вызова): пополнить, проверить, списать."""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        logger.warning("Weather API: token bucket empty (%.2f/%d)", self.tokens, self.capacity)
+        return False
 
     def can_make_request(self) -> bool:
-        current_hour_start = int(time.time() // 3600) * 3600
-        if self.last_hour_reset != current_hour_start:
-            self.hourly_calls = 0
-            self.last_hour_reset = current_hour_start
-            logger.info("Weather API: Hourly counter reset")
-        if self.hourly_calls >= WEATHER_HOURLY_LIMIT:
-            logger.warning(f"Weather API: Hourly limit reached ({self.hourly_calls}/{WEATHER_HOURLY_LIMIT})")
-            return False
-        return True
+        """Устаревшее имя, оставлено для совместимости."""
+        return self.try_consume()
 
-    def increment(self):
-        self.hourly_calls += 1
+    async def acquire(self, max_wait: float = WEATHER_ACQUIRE_MAX_WAIT) -> bool:
+        """Потребляет токен, при нехватке ждёт пополнения (не дольше max_wait).
+
+        Проверка и списание выполняются под общим asyncio.Lock: две
+        конкурентные корутины не могут списать один и тот же токен.
+        Токен резервируется (tokens уходит в минус) до сна, поэтому
+        ожидающие не мешают друг другу.
+        """
+        async with self._lock:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            wait = (1 - self.tokens) / self.rate
+            if wait > max_wait:
+                logger.warning("Weather API: bucket empty, refill in %.0fs > %.0fs — skip", wait, max_wait)
+                return False
+            self.tokens -= 1  # резерв наперёд: долг погасится пополнением
+        await asyncio.sleep(wait)
+        return True
 
     def get_remaining(self) -> int:
-        self.can_make_request()
-        return WEATHER_HOURLY_LIMIT - self.hourly_calls
+        self._refill()
+        return int(self.tokens)
 
 
 _weather_metrics = WeatherMetrics()
@@ -84,12 +130,99 @@ WMO_WEATHER_CODES = {
 }
 
 
+# WMO-коды — плотные маленькие числа (0..99): один раз раскладываем их в
+# кортеж и дальше берём по индексу вместо хэш-поиска в словаре.
+_WMO_DEFAULT = {"condition": "Неизвестно", "emoji": "🌡️", "precipitation": None}
+_WMO_TABLE = tuple(WMO_WEATHER_CODES.get(i, _WMO_DEFAULT) for i in range(100))
+
+
 def get_weather_info(code: int) -> Dict[str, Any]:
-    return WMO_WEATHER_CODES.get(code, {
-        "condition": "Неизвестно",
-        "emoji": "🌡️",
-        "precipitation": None
-    })
+    if isinstance(code, int) and 0 <= code < 100:
+        return _WMO_TABLE[code]
+    return _WMO_DEFAULT
+
+
+# Валюты, которые показываем в дайджесте (курс к рублю)
+_FIAT_CODES = ("USD", "EUR", "CNY")
+
+
+@lru_cache(maxsize=8)
+def _fmt_date(ts: int) -> str:
+    """Дата обновления курса в формате дайджеста.
+
+    Метка time_last_updated меняется раз в сутки, а запросы идут чаще —
+    кэшируем strftime по самой метке.
+    """
+    return datetime.fromtimestamp(ts, tz=timezone.utc).strftime('%d.%m.%Y')
+
+
+async def _read_json(resp: aiohttp.ClientResponse) -> Any:
+    """Разбор JSON-ответа: orjson (SIMD, в разы быстрее stdlib) если доступен."""
+    if orjson is not None:
+        return orjson.loads(await resp.read())
+    return await resp.json()
+
+
+def ttl_cache(seconds: float, key_func: Optional[Callable] = None):
+    """Кэш результата корутины в памяти на seconds секунд.
+
+    Данные upstream меняются на масштабе минут (фиат — раз в сутки),
+    а запросы приходят на каждое обращение к боту — кэш убирает
+    дублирующиеся сетевые round-trip целиком. None (ошибка источника)
+    не кэшируется, чтобы не залипать на неудачном ответе.
+
+    Single-flight: конкурентные вызовы с одним ключом не дублируют
+    запрос — первый стартует fetch и кладёт Future, остальные ждут его.
+    """
+    def decorator(func: Callable) -> Callable:
+        store: Dict[Any, tuple] = {}
+        inflight: Dict[Any, asyncio.Future] = {}
+
+        @wraps(func)
+        async def wrapper(*args, **kwargs) -> Any:
+            key = key_func(*args, **kwargs) if key_func else ()
+            hit = store.get(key)
+            now = time.monotonic()
+            if hit is not None and now < hit[0]:
+                return hit[1]
+
+            fut = inflight.get(key)
+            if fut is not None:
+                return await fut
+
+            fut = asyncio.get_running_loop().create_future()
+            inflight[key] = fut
+            try:
+                result = await func(*args, **kwargs)
+            except BaseException as e:
+                fut.set_exception(e)
+                fut.exception()  # создатель пробросит сам — гасим "never retrieved"
+                raise
+            finally:
+                inflight.pop(key, None)
+            if result is not None:
+                store[key] = (time.monotonic() + seconds, result)
+            fut.set_result(result)
+            return result
+
+        wrapper.cache_clear = store.clear
+        return wrapper
+    return decorator
+
+
+# Стоит ретраить только временные сбои; 400/401/403/404 не починятся сами
+_RETRYABLE_STATUSES = frozenset({408, 425, 429, 500, 502, 503, 504})
+
+
+def _retry_after_seconds(exc: aiohttp.ClientError) -> Optional[float]:
+    """Извлекает Retry-After (секунды) из ClientResponseError, если сервер прислал."""
+    headers = getattr(exc, "headers", None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
 
 
 def with_retry(max_retries: int = MAX_RETRIES,
@@ -99,137 +232,172 @@ def with_retry(max_retries: int = MAX_RETRIES,
         @wraps(func)
         async def wrapper(*args, **kwargs) -> Any:
             last_exception = None
+            # Decorrelated jitter (AWS): детерминированный 2**attempt
+            # синхронизирует ретраи конкурентных вызовов и повторно бьёт
+            # по upstream волной; случайная задержка размазывает их.
+            delay = delay_base
             for attempt in range(max_retries):
                 try:
                     return await func(*args, **kwargs)
                 except aiohttp.ClientError as e:
+                    if (isinstance(e, aiohttp.ClientResponseError)
+                            and e.status not in _RETRYABLE_STATUSES):
+                        raise  # постоянная ошибка — ретраи только тратят время
                     last_exception = e
                     if attempt < max_retries - 1:
-                        delay = min(delay_base * (2 ** attempt), delay_max)
+                        retry_after = _retry_after_seconds(e)
+                        if retry_after is not None:
+                            delay = min(retry_after, delay_max)
+                        else:
+                            delay = min(delay_max, random.uniform(delay_base, delay * 3))
                         logger.warning(
-                            f"Retry {attempt + 1}/{max_retries} for {func.__name__} "
-                            f"after {delay:.1f}s: {e}"
+                            "Retry %d/%d for %s after %.1fs: %s",
+                            attempt + 1, max_retries, func.__name__, delay, e,
                         )
                         await asyncio.sleep(delay)
                 except Exception:
                     raise
-            logger.error(f"All {max_retries} retries failed for {func.__name__}")
+            logger.error("All %d retries failed for %s", max_retries, func.__name__)
             raise last_exception if last_exception else Exception("Unknown error")
         return wrapper
     return decorator
 
 
+# Общая HTTP-сессия на модуль: каждый экземпляр APIClient переиспользует
+# один пул соединений, иначе клиент «на запрос» платит TCP+TLS handshake
+# к каждому из трёх хостов (Open-Meteo, CoinGecko, ExchangeRate) заново.
+_SHARED_SESSION: Optional[aiohttp.ClientSession] = None
+_SESSION_LOCK = asyncio.Lock()
+
+
+async def _get_shared_session() -> aiohttp.ClientSession:
+    global _SHARED_SESSION
+    if _SHARED_SESSION is None or _SHARED_SESSION.closed:
+        async with _SESSION_LOCK:
+            if _SHARED_SESSION is None or _SHARED_SESSION.closed:
+                _SHARED_SESSION = aiohttp.ClientSession(
+                    timeout=REQUEST_TIMEOUT,
+                    connector=aiohttp.TCPConnector(
+                        limit=100,
+                        limit_per_host=20,
+                        ttl_dns_cache=300,
+                        use_dns_cache=True,
+                        keepalive_timeout=75,
+                        enable_cleanup_closed=True,
+                    )
+                )
+    return _SHARED_SESSION
+
+
+async def _close_shared_session():
+    global _SHARED_SESSION
+    if _SHARED_SESSION and not _SHARED_SESSION.closed:
+        await _SHARED_SESSION.close()
+    _SHARED_SESSION = None
+
+
 class APIClient:
     """Асинхронный клиент: погода, криптовалюты, курсы валют."""
 
-    def __init__(self):
-        self._session: Optional[aiohttp.ClientSession] = None
-
     async def _get_session(self) -> aiohttp.ClientSession:
-        if self._session is None or self._session.closed:
-            self._session = aiohttp.ClientSession(
-                timeout=REQUEST_TIMEOUT,
-                connector=aiohttp.TCPConnector(limit=10, limit_per_host=5)
-            )
-        return self._session
+        return await _get_shared_session()
 
     async def close(self):
-        if self._session and not self._session.closed:
-            await self._session.close()
+        await _close_shared_session()
 
     @staticmethod
     def _validate_coords(lat: float, lon: float) -> bool:
         return -90 <= lat <= 90 and -180 <= lon <= 180
 
     # === ПОГОДА ===
+    # Ключ — координаты с точностью 0.01° (~1 км), как в CacheManager
+    @ttl_cache(seconds=600, key_func=lambda self, lat, lon: (round(lat, 2), round(lon, 2)))
     @with_retry(max_retries=2)
     async def fetch_weather(self, lat: float, lon: float) -> Optional[Dict[str, Any]]:
-        if not _weather_metrics.can_make_request():
-            return None
         if not self._validate_coords(lat, lon):
-            logger.warning(f"Invalid coords: {lat}, {lon}")
+            logger.warning("Invalid coords: %s, %s", lat, lon)
+            return None
+        # Квантуем до 0.01° (~1 км — внутри сетки прогноза): одинаковые
+        # города дают одинаковые параметры запроса и ключи кэша.
+        lat, lon = round(lat, 2), round(lon, 2)
+        if not await _weather_metrics.acquire():
             return None
         try:
             session = await self._get_session()
             params = {
                 "latitude": lat,
                 "longitude": lon,
-                "current": "temperature_2m,relative_humidity_2m,weather_code,cloud_cover,precipitation",
-                "timezone": "auto"
+                "current": _WEATHER_CURRENT,
+                "timezone": _WEATHER_TZ,
             }
-            _weather_metrics.increment()
             async with session.get(f"{OPEN_METEO_BASE}/forecast", params=params) as resp:
                 resp.raise_for_status()
-                data = await resp.json()
+                data = await _read_json(resp)
                 current = data.get("current", {})
-                weather_code = current.get("weather_code", 0)
+                g = current.get  # локальная ссылка: без повторного поиска атрибута
+                weather_code = g("weather_code", 0)
                 info = get_weather_info(weather_code)
                 return {
-                    "temperature":      current.get("temperature_2m"),
-                    "humidity":         current.get("relative_humidity_2m"),
+                    "temperature":      g("temperature_2m"),
+                    "humidity":         g("relative_humidity_2m"),
                     "weather_code":     weather_code,
-                    "cloud_cover":      current.get("cloud_cover", 0),
-                    "precipitation":    current.get("precipitation", 0),
+                    "cloud_cover":      g("cloud_cover", 0),
+                    "precipitation":    g("precipitation", 0),
                     "condition":        info["condition"],
                     "condition_emoji":  info["emoji"],
                     "precipitation_type": info["precipitation"],
-                    "time":             current.get("time", ""),
+                    "time":             g("time", ""),
                 }
         except aiohttp.ClientError as e:
-            logger.error(f"Weather error: {e}")
+            logger.error("Weather error: %s", e)
             return None
         except Exception as e:
-            logger.error(f"Weather unexpected error: {e}")
+            logger.error("Weather unexpected error: %s", e)
             return None
 
     def get_weather_remaining_requests(self) -> int:
         return _weather_metrics.get_remaining()
 
     # === КРИПТОВАЛЮТЫ ===
+    @ttl_cache(seconds=60)
     @with_retry(max_retries=3)
     async def fetch_crypto_prices(self) -> Optional[Dict[str, Any]]:
         try:
             session = await self._get_session()
             async with session.get(COINGECKO_URL, params=COINGECKO_PARAMS) as resp:
                 resp.raise_for_status()
-                return await resp.json()
+                return await _read_json(resp)
         except aiohttp.ClientError as e:
-            logger.error(f"CoinGecko error: {e}")
+            logger.error("CoinGecko error: %s", e)
             return None
         except Exception as e:
-            logger.error(f"Crypto unexpected error: {e}")
+            logger.error("Crypto unexpected error: %s", e)
             return None
 
     # === ВАЛЮТЫ ===
+    # Нужные коды фиксированы — извлекаем один раз списком вместо
+    # замыкания с повторными dict-lookup на каждый код.
+    @ttl_cache(seconds=3600)
     @with_retry(max_retries=3)
     async def fetch_fiat_rates(self) -> Optional[Dict[str, Any]]:
         try:
             session = await self._get_session()
             async with session.get(EXCHANGE_RATE_URL) as resp:
                 resp.raise_for_status()
-                data = await resp.json()
+                data = await _read_json(resp)
                 rates = data.get("rates", {})
-
-                def rub_per(code: str) -> Optional[float]:
-                    rate = rates.get(code)
-                    return round(1 / rate, 2) if rate else None
-
+                vals = [rates.get(code) for code in _FIAT_CODES]
+                inverted = [round(1 / v, 2) if v else None for v in vals]
                 return {
-                    "date": datetime.fromtimestamp(
-                        data.get("time_last_updated", 0), tz=timezone.utc
-                    ).strftime('%d.%m.%Y'),
+                    "date": _fmt_date(data.get("time_last_updated", 0)),
                     "base": "RUB",
-                    "rates": {
-                        "USD": rub_per("USD"),
-                        "EUR": rub_per("EUR"),
-                        "CNY": rub_per("CNY"),
-                    }
+                    "rates": dict(zip(_FIAT_CODES, inverted)),
                 }
         except aiohttp.ClientError as e:
-            logger.error(f"ExchangeRate error: {e}")
+            logger.error("ExchangeRate error: %s", e)
             return None
         except Exception as e:
-            logger.error(f"Fiat unexpected error: {e}")
+            logger.error("Fiat unexpected error: %s", e)
             return None
 
     # === ОБЩЕЕ ОБНОВЛЕНИЕ (без новостей) ===
@@ -238,23 +406,24 @@ class APIClient:
         Загружает крипту и курсы валют параллельно.
         Новости — отдельно через NewsDigest.refresh_all().
         """
-        results = await asyncio.gather(
-            self.fetch_crypto_prices(),
-            self.fetch_fiat_rates(),
-            return_exceptions=True
-        )
-
-        def safe(r, name):
-            if isinstance(r, Exception):
-                logger.warning(f"{name} failed: {r}")
+        async def safe(coro, name):
+            # Ошибка одного источника не должна отменять остальные задачи
+            # TaskGroup, поэтому гасим её внутри и возвращаем None.
+            try:
+                return await coro
+            except Exception as e:
+                logger.warning("%s failed: %s", name, e)
                 return None
-            return r
+
+        async with asyncio.TaskGroup() as tg:
+            crypto_task = tg.create_task(safe(self.fetch_crypto_prices(), "crypto"))
+            fiat_task = tg.create_task(safe(self.fetch_fiat_rates(), "fiat"))
 
         data = {
-            "crypto":     safe(results[0], "crypto"),
-            "fiat":       safe(results[1], "fiat"),
+            "crypto":     crypto_task.result(),
+            "fiat":       fiat_task.result(),
             "fetched_at": datetime.now(timezone.utc).isoformat()
         }
         ok = sum(1 for v in [data["crypto"], data["fiat"]] if v)
-        logger.info(f"fetch_all_data: {ok}/2 sources ok")
+        logger.info("fetch_all_data: %d/2 sources ok", ok)
         return data
\ No newline at end of file
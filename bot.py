@@ -6,10 +6,13 @@ Reply-клавиатуры вместо inline
 import asyncio
 import os
 import logging
+from contextlib import AsyncExitStack
+from concurrent.futures import ThreadPoolExecutor
+import signal
 import sys
-import traceback
-import html
+import time
 from datetime import datetime, timezone, timedelta
+from functools import lru_cache
 from pathlib import Path
 from typing import Optional, Dict, Any
 
@@ -18,10 +21,20 @@ load_dotenv(dotenv_path=Path(__file__).parent / ".env", override=True)
 
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command, CommandStart, CommandObject
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import (
+    BotCommand, ReplyKeyboardMarkup, KeyboardButton,
+    InlineKeyboardMarkup, InlineKeyboardButton,
+)
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter,
+)
 from aiogram.client.default import DefaultBotProperties
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from aiogram.client.session.aiohttp import AiohttpSession
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson необязателен
+    orjson = None
 
 from config import (
     BOT_TOKEN, LOG_LEVEL,
@@ -30,11 +43,14 @@ from config import (
     PREMIUM_PROMO_TEXT, DONATE_BUTTON_URL, DB_PATH, CACHE_PATH,
     RATE_LIMIT_SECONDS, MARKET_CACHE_PATH, NEWS_CACHE_PATH, ADMIN_ID
 )
+from buttons import SETTINGS_BUTTON_MAP, NEWS_BUTTON_MAP
 from database import Database, BROADCAST_HOURS
 from cache_manager import CacheManager
 from api_client import APIClient
 from market_digest import MarketDigest
 from news_digest import NewsDigest
+from cachetools import TTLCache, LRUCache
+
 from utils.decorators import (
     rate_limit, handle_telegram_errors, track_usage, get_usage_stats
 )
@@ -53,24 +69,212 @@ logging.basicConfig(
     stream=sys.stdout,
     force=True
 )
+
+# Вывод в stdout уходит через фоновый поток (QueueListener): записи
+# логов во время рассылки не блокируют event loop на I/O терминала.
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+_root_logger = logging.getLogger()
+_log_listener = QueueListener(
+    _log_queue, *_root_logger.handlers, respect_handler_level=True
+)
+_root_logger.handlers = [QueueHandler(_log_queue)]
+_log_listener.start()
+
 logger = logging.getLogger(__name__)
 
+# === BROADCAST TUNING ===
+# Telegram разрешает ~30 сообщений/сек на бота; 25 потребителей очереди
+# держат пул соединений занятым, не упираясь в глобальный лимит.
+BROADCAST_CONCURRENCY = 25
+# Глобальный темп отправки: с прогретым пулом 25 потребителей выдают
+# сотни msg/s, поэтому каждый send берёт слот у токен-бакета. 25/с —
+# чуть ниже лимита Telegram, запас на ответы командами вне рассылки.
+BROADCAST_RATE_PER_SEC = 25
+# Ёмкость очереди producer/consumer: естественный backpressure —
+# продюсер (форматирование) не обгоняет отправку больше чем на 1000 задач
+BROADCAST_QUEUE_MAXSIZE = 1000
+
+# Московский часовой пояс — один объект на модуль, а не на каждый дайджест
+_MSK = timezone(timedelta(hours=3), name="MSK")
+
+# Путь, на который Telegram доставляет апдейты в webhook-режиме
+WEBHOOK_PATH = "/webhook"
+
+# Города: первые 8 — для клавиатуры, frozenset — для O(1) валидации ввода
+_CITY_KEYS_FIRST8 = list(CITY_COORDINATES.keys())[:8]
+_CITY_SET = frozenset(CITY_COORDINATES)
+
+
+@lru_cache(maxsize=1024)
+def _coords_for(city: str) -> tuple:
+    """Координаты города с нормализацией регистра/пробелов.
+
+    lru_cache: повторные обращения (дайджест, рассылка) не платят за
+    strip/lower — города приходят из ограниченного словаря.
+    """
+    return CITY_COORDINATES.get(city.strip().lower(), (DEFAULT_LAT, DEFAULT_LON))
+
+# Часы рассылки как frozenset — O(1) проверка в обработчике кнопок времени
+_BROADCAST_HOURS = frozenset(BROADCAST_HOURS)
+
+# Статический каркас клавиатуры настроек: разделители и кнопка «назад»
+# неизменны, пересобирать их на каждый toggle незачем. Категории хранятся
+# кортежами — per-call остаётся только подстановка префикса ✅/❌.
+_SETTINGS_SEP_MAIN = [KeyboardButton(text="─── Основное ───")]
+_SETTINGS_SEP_NEWS = [KeyboardButton(text="─── Новости ───")]
+_SETTINGS_SEP_BROADCAST = [KeyboardButton(text="─── Рассылка ───")]
+_SETTINGS_BACK_ROW = [KeyboardButton(text="🔙 Назад в меню")]
+_SETTINGS_BASE_ITEMS = tuple(BASE_CATEGORIES.items())
+_SETTINGS_NEWS_ITEMS = tuple(NEWS_CATS_CONFIG.items())
+
+
+@lru_cache(maxsize=24)
+def _settings_time_button(hour: int) -> KeyboardButton:
+    """Кнопка времени рассылки — по одной на каждый допустимый час."""
+    return KeyboardButton(text=f"⏰ Время: {hour:02d}:00 МСК")
+
+
+# Константы дайджеста: (ключ настройки, категория API, подпись) и метки
+# валют. Дайджест рендерится на каждого получателя рассылки — итерируем
+# разделяемые read-only кортежи вместо пересоздания dict/list на вызов.
+_NEWS_CATEGORY_MAP: tuple = (
+    ("news_top", "top", "📰 Главное"),
+    ("news_world", "world", "🌍 В мире"),
+    ("news_technology", "technology", "💻 Технологии"),
+    ("news_business", "business", "💼 Бизнес"),
+    ("news_science", "science", "🔬 Наука"),
+    ("news_health", "health", "🏥 Здоровье"),
+    ("news_sports", "sports", "⚽ Спорт"),
+    ("news_entertainment", "entertainment", "🎬 Развлечения"),
+    ("news_politics", "politics", "🏛️ Политика"),
+)
+_FIAT_LABELS = (("USD", "🇺🇸 Доллар"), ("EUR", "🇪🇺 Евро"), ("CNY", "🇨🇳 Юань"))
+
+# Таблица HTML-экранирования для str.translate: тот же результат, что у
+# html.escape, но одним C-проходом — вызывается на каждого получателя
+# рассылки (город, имя, заголовки новостей)
+_HTML_ESCAPE = str.maketrans({
+    "&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#x27;",
+})
+
+# Текст крипто-замка: константная часть разобрана один раз при импорте,
+# per-call остаётся только подстановка ссылки
+_CRYPTO_LOCKED_TEMPLATE = (
+    "🔒 <b>Крипто-дайджест заблокирован</b>\n\n"
+    "Пригласи <b>одного друга</b> и разблокируй эту функцию!\n\n"
+    "🔗 Твоя реферальная ссылка:\n<code>{ref_link}</code>\n\n"
+    "⏳ Ссылка действительна 7 дней"
+)
+
+# Критичные пути для check_critical_files: (метка, путь)
+PATH_LABELS = (
+    ("DB", DB_PATH),
+    ("Cache", CACHE_PATH),
+    ("Market", MARKET_CACHE_PATH),
+    ("News", NEWS_CACHE_PATH),
+)
+
+# Команды бота: (команда, атрибут-обработчик, описание для меню Telegram);
+# /start регистрируется отдельно через CommandStart
+COMMAND_HANDLERS = (
+    ("help", "cmd_help", "Справка по командам"),
+    ("ping", "cmd_ping", "Проверка работоспособности"),
+    ("stats", "cmd_stats", "Статистика бота"),
+    ("api", "cmd_api_metrics", "Метрики API (для админа)"),
+)
+
+# Приветствие /start: константная часть собрана при импорте, per-call
+# подставляется только экранированное имя
+_WELCOME_TEMPLATE = (
+    "👋 Привет, {name}!\n\n"
+    "Я — <b>ИнфоХаб</b>, твой персональный агрегатор.\n\n"
+    "🔹 Дайджест раз в день\n"
+    "🔹 Настраивай категории под себя\n"
+    "🔹 0 рублей затрат!\n\n"
+    "Используй кнопки меню ниже 👇\n\n"
+    "📝 /help — справка по командам"
+)
+
+# Текст /help статичен — одна строка на модуль вместо литерала в обработчике
+_HELP_TEXT = """
+📖 <b>Справка по боту ИнфоХаб</b>
+
+<b>Команды:</b>
+/start — Запуск бота
+/help — Эта справка
+/ping — Проверка работоспособности
+/stats — Статистика бота
+
+<b>Кнопки меню:</b>
+📊 <b>Мой дайджест</b> — Получить сводку сейчас
+📰 <b>Новости</b> — Новости, крипто-дайджест
+⚙️ <b>Настройки</b> — Выбрать категории
+🌍 <b>Сменить город</b> — Указать свой город
+
+<b>Категории дайджеста:</b>
+• 🌤 Погода • 💰 Криптовалюты • 💱 Курсы валют
+• 📰 Новости (10 категорий на выбор)
+
+<b>Время рассылки:</b>
+Настраиваемое (утро 6-12, вечер 18-21)
+"""
+
 
 class BotApp:
     """Главный класс приложения бота."""
 
     def __init__(self):
-        self.bot: Optional[Bot] = None
-        self.dp: Optional[Dispatcher] = None
         self.db: Optional[Database] = None
         self.api_client: Optional[APIClient] = None
         self.cache_manager: Optional[CacheManager] = None
         self.market_digest: Optional[MarketDigest] = None
         self.news_digest: Optional[NewsDigest] = None
-        self.scheduler: Optional[AsyncIOScheduler] = None
+        # Фоновые задачи планировщика, создаются в _setup_scheduler
+        self._sched_tasks: list = []
         self.keyboards: Dict[str, Any] = {}
+        self._format_pool: Optional[ThreadPoolExecutor] = None
+        self._bot_username: Optional[str] = None
         self._shutdown_requested: bool = False
+        # Темп рассылки: метка monotonic-времени ближайшего свободного
+        # слота отправки, выдаётся под локом (см. _pace_broadcast)
+        self._pace_lock = asyncio.Lock()
+        self._next_send_at: float = 0.0
+        # Контекст пользователя (state, prefs, hour, city) с коротким TTL:
+        # обработчики кнопок читают одни и те же данные несколько раз
+        # подряд — кэш сводит 2-3 SQLite-запроса на нажатие к одному
+        self._user_ctx_cache: TTLCache = TTLCache(maxsize=10_000, ttl=5)
+        # Мемоизация готовых дайджестов: ключ включает поколение кэша
+        # данных и минутную метку — новые данные/минута инвалидируют запись
+        self._digest_memo: LRUCache = LRUCache(maxsize=512)
         # _user_state удалён — состояние хранится в БД (миграция v5, last_state)
+        # Глобальные кнопки: один hash-lookup вместо цепочки сравнений
+        self._top_dispatch = {
+            "📊 Мой дайджест": self._send_digest_now,
+            "📰 Новости": self._enter_news,
+            "⚙️ Настройки": self._open_settings,
+            "🌍 Сменить город": self._enter_city,
+            "🔙 Назад в меню": self._back_to_main,
+        }
+        # State-зависимые кнопки: таблица вместо цепочки elif по state
+        self._state_dispatch = {
+            "settings": self._handle_settings_button,
+            "time": self._handle_time_button,
+            "city": self._handle_city_button,
+            "news": self._handle_news_button,
+            "crypto": self._handle_crypto_button,
+        }
+        # Bot и Dispatcher живут один раз за жизнь приложения — без
+        # пересоздания роутеров/фильтров при каждом run()
+        self.bot: Bot = Bot(
+            token=BOT_TOKEN,
+            session=self._create_bot_session(),
+            default=DefaultBotProperties(parse_mode="HTML"),
+        )
+        self.dp: Dispatcher = Dispatcher()
+        self._configure_dispatcher()
 
     # === KEYBOARD BUILDERS (REPLY) ===
     def _create_keyboards(self) -> Dict[str, Any]:
@@ -88,20 +292,19 @@ class BotApp:
             )
 
         def get_settings_keyboard(user_prefs: dict, broadcast_hour: int = 9):
-            buttons = []
-            logger.debug(f"Settings keyboard prefs: {user_prefs}")
+            # Статичные ряды берём из готового каркаса; заново создаются
+            # только кнопки категорий (их текст зависит от user_prefs)
+            logger.debug("Settings keyboard prefs: %s", user_prefs)
 
-            buttons.append([KeyboardButton(text="─── Основное ───")])
-            for cat_key, cat_name in BASE_CATEGORIES.items():
-                is_enabled = user_prefs.get(cat_key, True)
-                status = "✅" if is_enabled else "❌"
+            buttons = [_SETTINGS_SEP_MAIN]
+            for cat_key, cat_name in _SETTINGS_BASE_ITEMS:
+                status = "✅" if user_prefs.get(cat_key, True) else "❌"
                 buttons.append([KeyboardButton(text=f"{status} {cat_name}")])
 
-            buttons.append([KeyboardButton(text="─── Новости ───")])
+            buttons.append(_SETTINGS_SEP_NEWS)
             news_row = []
-            for cat_key, cat_name in NEWS_CATS_CONFIG.items():
-                is_enabled = user_prefs.get(cat_key, True)
-                status = "✅" if is_enabled else "❌"
+            for cat_key, cat_name in _SETTINGS_NEWS_ITEMS:
+                status = "✅" if user_prefs.get(cat_key, True) else "❌"
                 news_row.append(KeyboardButton(text=f"{status} {cat_name}"))
                 if len(news_row) == 2:
                     buttons.append(news_row)
@@ -109,23 +312,16 @@ class BotApp:
             if news_row:
                 buttons.append(news_row)
 
-            buttons.append([KeyboardButton(text="─── Рассылка ───")])
-            time_str = f"⏰ Время: {broadcast_hour:02d}:00 МСК"
-            buttons.append([KeyboardButton(text=time_str)])
-            buttons.append([KeyboardButton(text="🔙 Назад в меню")])
+            buttons.append(_SETTINGS_SEP_BROADCAST)
+            buttons.append([_settings_time_button(broadcast_hour)])
+            buttons.append(_SETTINGS_BACK_ROW)
 
             return ReplyKeyboardMarkup(keyboard=buttons, resize_keyboard=True)
 
-        def get_time_keyboard(current_hour: int = 9):
+        def build_time_keyboard(current_hour: int):
             buttons = []
             row = []
-            for hour in [6, 7, 8, 9, 10, 11, 12]:
-                marker = "✓ " if hour == current_hour else ""
-                row.append(KeyboardButton(text=f"{marker}{hour:02d}:00"))
-                if len(row) == 4:
-                    buttons.append(row)
-                    row = []
-            for hour in [18, 19, 20, 21]:
+            for hour in BROADCAST_HOURS:
                 marker = "✓ " if hour == current_hour else ""
                 row.append(KeyboardButton(text=f"{marker}{hour:02d}:00"))
                 if len(row) == 4:
@@ -136,10 +332,17 @@ class BotApp:
             buttons.append([KeyboardButton(text="🔙 Назад в настройки")])
             return ReplyKeyboardMarkup(keyboard=buttons, resize_keyboard=True)
 
+        # Вариантов клавиатуры времени ровно len(BROADCAST_HOURS) — строим
+        # все один раз и отдаём готовую разметку по выбранному часу
+        time_keyboards = {h: build_time_keyboard(h) for h in BROADCAST_HOURS}
+
+        def get_time_keyboard(current_hour: int = 9):
+            return time_keyboards.get(current_hour, time_keyboards[9])
+
         def get_city_keyboard():
             buttons = []
             row = []
-            for city in list(CITY_COORDINATES.keys())[:8]:
+            for city in _CITY_KEYS_FIRST8:
                 row.append(KeyboardButton(text=city.title()))
                 if len(row) == 2:
                     buttons.append(row)
@@ -172,12 +375,15 @@ class BotApp:
                 resize_keyboard=True
             )
 
+        # main/news/city/crypto не зависят от пользователя — строим один раз
+        # и храним готовые ReplyKeyboardMarkup (без pydantic-валидации на
+        # каждое нажатие). Фабрики остаются только у settings и time.
         return {
-            "main": get_main_keyboard,
+            "main": get_main_keyboard(),
             "settings": get_settings_keyboard,
-            "city": get_city_keyboard,
-            "news": get_news_keyboard,
-            "crypto": get_crypto_keyboard,
+            "city": get_city_keyboard(),
+            "news": get_news_keyboard(),
+            "crypto": get_crypto_keyboard(),
             "time": get_time_keyboard,
         }
 
@@ -188,9 +394,10 @@ class BotApp:
         user = message.from_user
         try:
             await self.db.add_user(user.id, user.username, user.first_name)
-            logger.info(f"👤 Пользователь: {user.id} (@{user.username})")
+            self._invalidate_user_ctx(user.id)
+            logger.info("👤 Пользователь: %s (@%s)", user.id, user.username)
         except Exception as e:
-            logger.error(f"Ошибка добавления пользователя {user.id}: {e}")
+            logger.error("Ошибка добавления пользователя %s: %s", user.id, e)
 
         referrer_id = None
         if command and command.args:
@@ -198,60 +405,32 @@ class BotApp:
             if args.startswith("ref_"):
                 try:
                     referrer_id = int(args[4:])
-                    logger.info(f"Referral: referrer={referrer_id}, new_user={user.id}")
+                    logger.info("Referral: referrer=%s, new_user=%s", referrer_id, user.id)
                 except ValueError:
-                    logger.warning(f"Invalid referral code: {args}")
+                    logger.warning("Invalid referral code: %s", args)
 
         if referrer_id:
             already_referred = await self.db.is_already_referred(user.id)
             if not already_referred and referrer_id != user.id:
                 success = await self.db.add_referral(referrer_id, user.id)
                 if success:
-                    logger.info(f"✅ Referral registered: {referrer_id} <- {user.id}")
-
-        await self.db.set_user_state(user.id, "main")
-
-        welcome_text = (
-            f"👋 Привет, {html.escape(user.first_name or 'друг')}!\n\n"
-            f"Я — <b>ИнфоХаб</b>, твой персональный агрегатор.\n\n"
-            f"🔹 Дайджест раз в день\n"
-            f"🔹 Настраивай категории под себя\n"
-            f"🔹 0 рублей затрат!\n\n"
-            f"Используй кнопки меню ниже 👇\n\n"
-            f"📝 /help — справка по командам"
+                    logger.info("✅ Referral registered: %s <- %s", referrer_id, user.id)
+
+        await self._safe_set_state(user.id, "main")
+
+        welcome_text = _WELCOME_TEMPLATE.format(
+            name=(user.first_name or "друг").translate(_HTML_ESCAPE)
         )
         await message.answer(
             welcome_text,
             parse_mode="HTML",
-            reply_markup=self.keyboards["main"]()
+            reply_markup=self.keyboards["main"]
         )
 
     @track_usage("help")
     @handle_telegram_errors
     async def cmd_help(self, message: types.Message):
-        help_text = """
-📖 <b>Справка по боту ИнфоХаб</b>
-
-<b>Команды:</b>
-/start — Запуск бота
-/help — Эта справка
-/ping — Проверка работоспособности
-/stats — Статистика бота
-
-<b>Кнопки меню:</b>
-📊 <b>Мой дайджест</b> — Получить сводку сейчас
-📰 <b>Новости</b> — Новости, крипто-дайджест
-⚙️ <b>Настройки</b> — Выбрать категории
-🌍 <b>Сменить город</b> — Указать свой город
-
-<b>Категории дайджеста:</b>
-• 🌤 Погода • 💰 Криптовалюты • 💱 Курсы валют
-• 📰 Новости (10 категорий на выбор)
-
-<b>Время рассылки:</b>
-Настраиваемое (утро 6-12, вечер 18-21)
-"""
-        await message.answer(help_text, parse_mode="HTML")
+        await message.answer(_HELP_TEXT, parse_mode="HTML")
 
     @track_usage("ping")
     @handle_telegram_errors
@@ -276,7 +455,7 @@ class BotApp:
                 stats_text += f"  • {action}: {count}\n"
             await message.answer(stats_text, parse_mode="HTML")
         except Exception as e:
-            logger.error(f"Error getting stats: {e}")
+            logger.error("Error getting stats: %s", e)
             await message.answer("❌ Ошибка получения статистики")
 
     @handle_telegram_errors
@@ -309,7 +488,7 @@ class BotApp:
                 lines.append(f"   Кэш: {mm['cache_entries']} записей")
             await message.answer("\n".join(lines), parse_mode="HTML")
         except Exception as e:
-            logger.error(f"Error getting metrics: {e}")
+            logger.error("Error getting metrics: %s", e)
             await message.answer("❌ Ошибка получения метрик")
 
     @handle_telegram_errors
@@ -318,76 +497,24 @@ class BotApp:
         user_id = message.from_user.id
         text = message.text
 
-        # Глобальные кнопки — не требуют чтения state из БД
-        if text == "📊 Мой дайджест":
-            await self._send_digest_now(message)
-            return
-
-        if text == "📰 Новости":
-            await self._safe_set_state(user_id, "news")
-            await message.answer(
-                "📰 <b>Новости</b>\n\nВыберите категорию:",
-                parse_mode="HTML",
-                reply_markup=self.keyboards["news"]()
-            )
-            return
-
-        if text == "⚙️ Настройки":
-            try:
-                await self._safe_set_state(user_id, "settings")
-                await self.db.add_user(user_id, message.from_user.username, message.from_user.first_name)
-                prefs = await self.db.get_user_preferences(user_id)
-                broadcast_hour = await self.db.get_broadcast_hour(user_id)
-                logger.info(f"Settings opened for {user_id}: {len(prefs)} cats, hour={broadcast_hour}")
-                await message.answer(
-                    "⚙️ <b>Настройки категорий</b>\n\nНажмите на категорию, чтобы включить/выключить:",
-                    parse_mode="HTML",
-                    reply_markup=self.keyboards["settings"](prefs, broadcast_hour)
-                )
-            except Exception as e:
-                logger.error(f"Error opening settings for {user_id}: {e}", exc_info=True)
-                await message.answer(
-                    "❌ Ошибка открытия настроек. Попробуйте позже.",
-                    reply_markup=self.keyboards["main"]()
-                )
-            return
-
-        if text == "🌍 Сменить город":
-            await self._safe_set_state(user_id, "city")
-            await message.answer(
-                "🌍 <b>Выберите город:</b>",
-                parse_mode="HTML",
-                reply_markup=self.keyboards["city"]()
-            )
+        # Глобальные кнопки обычно перехватываются фильтрами в
+        # _configure_dispatcher; lookup оставлен как дешёвая подстраховка
+        handler = self._top_dispatch.get(text)
+        if handler:
+            await handler(message)
             return
 
-        if text == "🔙 Назад в меню":
-            await self._safe_set_state(user_id, "main")
-            await message.answer(
-                "🏠 <b>Главное меню</b>",
-                parse_mode="HTML",
-                reply_markup=self.keyboards["main"]()
-            )
-            return
+        # Для state-зависимых кнопок читаем контекст из БД один раз
+        state, _, _, _ = await self._get_user_ctx(user_id)
 
-        # Для state-зависимых кнопок читаем state из БД один раз
-        state = await self.db.get_user_state(user_id)
-
-        if state == "settings":
-            await self._handle_settings_button(message)
-        elif state == "time":
-            await self._handle_time_button(message)
-        elif state == "city":
-            await self._handle_city_button(message)
-        elif state == "news":
-            await self._handle_news_button(message)
-        elif state == "crypto":
-            await self._handle_crypto_button(message)
+        state_handler = self._state_dispatch.get(state)
+        if state_handler:
+            await state_handler(message)
         else:
             await self._safe_set_state(user_id, "main")
             await message.answer(
                 "🤔 Не понимаю. Используйте кнопки меню.",
-                reply_markup=self.keyboards["main"]()
+                reply_markup=self.keyboards["main"]
             )
 
     async def _safe_set_state(self, user_id: int, state: str) -> None:
@@ -395,8 +522,71 @@ class BotApp:
         try:
             await self.db.set_user_state(user_id, state)
         except ValueError as e:
-            logger.error(f"Invalid state '{state}' for user {user_id}: {e}")
+            logger.error("Invalid state '%s' for user %s: %s", state, user_id, e)
             await self.db.set_user_state(user_id, "main")
+        self._invalidate_user_ctx(user_id)
+
+    async def _get_user_ctx(self, user_id: int) -> tuple:
+        """(state, prefs, broadcast_hour, city) одним запросом с TTL-кэшем."""
+        ctx = self._user_ctx_cache.get(user_id)
+        if ctx is None:
+            ctx = await self.db.get_user_context(user_id)
+            self._user_ctx_cache[user_id] = ctx
+        return ctx
+
+    def _invalidate_user_ctx(self, user_id: int) -> None:
+        """Сброс кэша контекста после записи в БД."""
+        self._user_ctx_cache.pop(user_id, None)
+
+    # === TOP-LEVEL MENU HANDLERS ===
+    async def _enter_news(self, message: types.Message):
+        await self._safe_set_state(message.from_user.id, "news")
+        await message.answer(
+            "📰 <b>Новости</b>\n\nВыберите категорию:",
+            parse_mode="HTML",
+            reply_markup=self.keyboards["news"]
+        )
+
+    async def _open_settings(self, message: types.Message):
+        user_id = message.from_user.id
+        try:
+            # Независимые записи идут конкурентно; контекст читается один
+            # раз после того, как обе завершились
+            async with asyncio.TaskGroup() as tg:
+                tg.create_task(self._safe_set_state(user_id, "settings"))
+                tg.create_task(self.db.add_user(
+                    user_id, message.from_user.username, message.from_user.first_name
+                ))
+            self._invalidate_user_ctx(user_id)
+            _, prefs, broadcast_hour, _ = await self._get_user_ctx(user_id)
+            logger.info("Settings opened for %s: %d cats, hour=%s", user_id, len(prefs), broadcast_hour)
+            await message.answer(
+                "⚙️ <b>Настройки категорий</b>\n\nНажмите на категорию, чтобы включить/выключить:",
+                parse_mode="HTML",
+                reply_markup=self.keyboards["settings"](prefs, broadcast_hour)
+            )
+        except Exception as e:
+            logger.error("Error opening settings for %s: %s", user_id, e, exc_info=True)
+            await message.answer(
+                "❌ Ошибка открытия настроек. Попробуйте позже.",
+                reply_markup=self.keyboards["main"]
+            )
+
+    async def _enter_city(self, message: types.Message):
+        await self._safe_set_state(message.from_user.id, "city")
+        await message.answer(
+            "🌍 <b>Выберите город:</b>",
+            parse_mode="HTML",
+            reply_markup=self.keyboards["city"]
+        )
+
+    async def _back_to_main(self, message: types.Message):
+        await self._safe_set_state(message.from_user.id, "main")
+        await message.answer(
+            "🏠 <b>Главное меню</b>",
+            parse_mode="HTML",
+            reply_markup=self.keyboards["main"]
+        )
 
     # === SETTINGS HANDLERS ===
     async def _handle_settings_button(self, message: types.Message):
@@ -405,12 +595,12 @@ class BotApp:
 
         if text == "🔙 Назад в меню":
             await self._safe_set_state(user_id, "main")
-            await message.answer("🏠 Главное меню", reply_markup=self.keyboards["main"]())
+            await message.answer("🏠 Главное меню", reply_markup=self.keyboards["main"])
             return
 
         if text.startswith("⏰ Время:"):
             await self._safe_set_state(user_id, "time")
-            current_hour = await self.db.get_broadcast_hour(user_id)
+            _, _, current_hour, _ = await self._get_user_ctx(user_id)
             await message.answer(
                 "⏰ Выберите время ежедневной рассылки:",
                 reply_markup=self.keyboards["time"](current_hour)
@@ -420,47 +610,28 @@ class BotApp:
         if text.startswith("───"):
             return
 
-        clean_text = text
-        if text.startswith("✅ "):
-            clean_text = text[2:].strip()
-        elif text.startswith("❌ "):
-            clean_text = text[2:].strip()
-
-        button_to_category = {
-            "🌤 Погода": "weather",
-            "💰 Криптовалюты": "crypto",
-            "💱 Курсы валют": "fiat",
-            "📰 Главное": "news_top",
-            "🌍 В мире": "news_world",
-            "💻 Технологии": "news_technology",
-            "💼 Бизнес": "news_business",
-            "🔬 Наука": "news_science",
-            "🏥 Здоровье": "news_health",
-            "⚽ Спорт": "news_sports",
-            "🎬 Развлечения": "news_entertainment",
-            "🏛️ Политика": "news_politics",
-            "📊 Все новости": "news_all",
-        }
+        # Кнопки строятся с фиксированным «✅ »/«❌ » — достаточно одного
+        # среза без strip
+        clean_text = text[2:] if text.startswith(("✅ ", "❌ ")) else text
 
-        found_cat_key = button_to_category.get(clean_text)
+        # Готовая обратная карта из buttons.py — один hash-lookup вместо
+        # словаря, пересоздаваемого на каждое нажатие
+        found_cat_key = SETTINGS_BUTTON_MAP.get(clean_text)
         if not found_cat_key:
-            logger.warning(f"Category not found: '{text}' (clean: '{clean_text}')")
+            logger.warning("Category not found: '%s' (clean: '%s')", text, clean_text)
             # FIX: возвращаем клавиатуру настроек, чтобы кнопки не пропали
-            prefs = await self.db.get_user_preferences(user_id)
-            broadcast_hour = await self.db.get_broadcast_hour(user_id)
+            _, prefs, broadcast_hour, _ = await self._get_user_ctx(user_id)
             await message.answer(
                 "🤔 Неизвестная категория.",
                 reply_markup=self.keyboards["settings"](prefs, broadcast_hour)
             )
             return
 
-        prefs = await self.db.get_user_preferences(user_id)
+        _, prefs, _, _ = await self._get_user_ctx(user_id)
         new_state = not prefs.get(found_cat_key, True)
-        logger.info(f"Toggle: user={user_id}, cat={found_cat_key} -> {new_state}")
-        await self.db.toggle_preference(user_id, found_cat_key, new_state)
-
-        prefs = await self.db.get_user_preferences(user_id)
-        broadcast_hour = await self.db.get_broadcast_hour(user_id)
+        logger.info("Toggle: user=%s, cat=%s -> %s", user_id, found_cat_key, new_state)
+        prefs, broadcast_hour = await self.db.toggle_and_fetch(user_id, found_cat_key, new_state)
+        self._invalidate_user_ctx(user_id)
         cat_name = CATEGORIES[found_cat_key]
         status_text = "включена ✅" if new_state else "выключена ❌"
         await message.answer(
@@ -475,8 +646,7 @@ class BotApp:
 
         if text == "🔙 Назад в настройки":
             await self._safe_set_state(user_id, "settings")
-            prefs = await self.db.get_user_preferences(user_id)
-            broadcast_hour = await self.db.get_broadcast_hour(user_id)
+            _, prefs, broadcast_hour, _ = await self._get_user_ctx(user_id)
             await message.answer("⚙️ Настройки",
                                  reply_markup=self.keyboards["settings"](prefs, broadcast_hour))
             return
@@ -484,10 +654,10 @@ class BotApp:
         try:
             time_str = text.replace("✓ ", "").replace("✓", "").strip()
             hour = int(time_str.split(":")[0])
-            if hour in BROADCAST_HOURS:
+            if hour in _BROADCAST_HOURS:
                 await self.db.set_broadcast_hour(user_id, hour)
                 await self._safe_set_state(user_id, "settings")
-                prefs = await self.db.get_user_preferences(user_id)
+                _, prefs, _, _ = await self._get_user_ctx(user_id)
                 await message.answer(
                     f"✅ Время рассылки: {hour:02d}:00 МСК",
                     reply_markup=self.keyboards["settings"](prefs, hour)
@@ -503,21 +673,21 @@ class BotApp:
 
         if text == "🔙 Назад в меню":
             await self._safe_set_state(user_id, "main")
-            await message.answer("🏠 Главное меню", reply_markup=self.keyboards["main"]())
+            await message.answer("🏠 Главное меню", reply_markup=self.keyboards["main"])
             return
 
         city_name = text.lower().strip()
-        if city_name in CITY_COORDINATES:
+        if city_name in _CITY_SET:
             try:
                 await self.db.update_city(user_id, city_name)
                 await self._safe_set_state(user_id, "main")
                 await message.answer(
                     f"✅ Город изменён на <b>{city_name.title()}</b>",
                     parse_mode="HTML",
-                    reply_markup=self.keyboards["main"]()
+                    reply_markup=self.keyboards["main"]
                 )
             except Exception as e:
-                logger.error(f"Ошибка обновления города: {e}")
+                logger.error("Ошибка обновления города: %s", e)
                 await message.answer("❌ Ошибка сохранения города")
         else:
             await message.answer("❌ Город не найден. Выберите из списка.")
@@ -528,7 +698,7 @@ class BotApp:
 
         if text == "🔙 Назад в меню":
             await self._safe_set_state(user_id, "main")
-            await message.answer("🏠 Главное меню", reply_markup=self.keyboards["main"]())
+            await message.answer("🏠 Главное меню", reply_markup=self.keyboards["main"])
             return
 
         if text == "💰 Крипто-дайджест":
@@ -539,24 +709,12 @@ class BotApp:
             await message.answer("❌ Сервис новостей недоступен")
             return
 
-        button_to_category = {
-            "📰 Главное": "top",
-            "🌍 В мире": "world",
-            "💻 Технологии": "technology",
-            "💼 Бизнес": "business",
-            "🔬 Наука": "science",
-            "🏥 Здоровье": "health",
-            "⚽ Спорт": "sports",
-            "🎬 Развлечения": "entertainment",
-            "🏛️ Политика": "politics",
-        }
-
         if text == "📊 Все новости":
             digest_text = self.news_digest.get_combined_digest(max_per_category=3)
             await message.answer(digest_text, parse_mode="HTML", disable_web_page_preview=True)
             return
 
-        category = button_to_category.get(text)
+        category = NEWS_BUTTON_MAP.get(text)
         if not category:
             await message.answer("❌ Неизвестная категория")
             return
@@ -578,15 +736,8 @@ class BotApp:
 
     async def _show_crypto_locked(self, message: types.Message):
         user_id = message.from_user.id
-        bot_username = (await self.bot.get_me()).username
-        ref_link = f"https://t.me/{bot_username}?start=ref_{user_id}"
-        text = (
-            "🔒 <b>Крипто-дайджест заблокирован</b>\n\n"
-            "Пригласи <b>одного друга</b> и разблокируй эту функцию!\n\n"
-            f"🔗 Твоя реферальная ссылка:\n<code>{ref_link}</code>\n\n"
-            "⏳ Ссылка действительна 7 дней"
-        )
-        from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+        ref_link = f"https://t.me/{self._bot_username}?start=ref_{user_id}"
+        text = _CRYPTO_LOCKED_TEMPLATE.format(ref_link=ref_link)
         keyboard = InlineKeyboardMarkup(
             inline_keyboard=[[InlineKeyboardButton(text="📋 Скопировать ссылку", url=ref_link)]]
         )
@@ -598,7 +749,7 @@ class BotApp:
 
         if text == "🔙 Назад в меню":
             await self._safe_set_state(user_id, "main")
-            await message.answer("🏠 Главное меню", reply_markup=self.keyboards["main"]())
+            await message.answer("🏠 Главное меню", reply_markup=self.keyboards["main"])
             return
 
         if not self.market_digest:
@@ -608,7 +759,7 @@ class BotApp:
         if text == "🔄 Обновить крипто":
             await self.market_digest.refresh_all()
             digest_text = self.market_digest.get_digest()
-            await message.answer(digest_text, parse_mode="HTML", reply_markup=self.keyboards["crypto"]())
+            await message.answer(digest_text, parse_mode="HTML", reply_markup=self.keyboards["crypto"])
 
     # === DIGEST ===
     @rate_limit(seconds=RATE_LIMIT_SECONDS)
@@ -617,155 +768,323 @@ class BotApp:
     async def _send_digest_now(self, message: types.Message):
         user_id = message.from_user.id
         try:
-            user_city = await self.db.get_user_city(user_id)
-            lat, lon = CITY_COORDINATES.get(user_city, (DEFAULT_LAT, DEFAULT_LON))
+            _, prefs, _, user_city = await self._get_user_ctx(user_id)
+            lat, lon = _coords_for(user_city or "москва")
             data = await self.cache_manager.get_data(lat, lon)
-            prefs = await self.db.get_user_preferences(user_id)
-            message_text = await self._format_digest(data, prefs, user_city)
+            message_text = self._format_digest_cached(data, prefs, user_city)
             await message.answer(message_text, parse_mode="HTML", disable_web_page_preview=True)
-            logger.info(f"📬 Дайджест отправлен {user_id}")
+            logger.debug("📬 Дайджест отправлен %s", user_id)
         except Exception as e:
-            logger.error(f"Ошибка дайджеста {user_id}: {e}")
+            logger.error("Ошибка дайджеста %s: %s", user_id, e)
             await message.answer("⚠️ Временно недоступно\n\nПопробуйте позже.")
 
-    async def _format_digest(self, cache_data: dict, prefs: dict, city: str) -> str:
-        msk = timezone(timedelta(hours=3))
-        current_time = datetime.now(msk).strftime('%d.%m %H:%M')
-        parts = [f"🗞 <b>ИнфоХаб</b> • {current_time} MSK • {html.escape(city.title())}"]
-
-        if prefs.get("weather") and cache_data.get("weather"):
-            w = cache_data["weather"]
-            temp = w.get('temperature', 'N/A')
-            condition = w.get('condition', 'Неизвестно')
-            emoji = w.get('condition_emoji', '🌡️')
-            precip_type = w.get('precipitation_type')
-            cloud_cover = w.get('cloud_cover', 0)
-            precip_str = f", {precip_type}" if precip_type else (", без осадков" if cloud_cover < 20 else "")
-            parts.append(f"\n{emoji} <b>Погода:</b> {temp}°C, {condition}{precip_str}")
-        elif prefs.get("weather"):
-            parts.append("\n🌡️ <b>Погода:</b> временно недоступно")
-
-        if prefs.get("crypto") and cache_data.get("crypto"):
-            crypto = cache_data["crypto"]
-            parts.append("\n💰 <b>Крипто:</b>")
-            for coin in ["bitcoin", "ethereum", "tether"]:
-                if coin in crypto:
-                    c = crypto[coin]
-                    usd = c.get("usd", 0)
-                    change = c.get("usd_24h_change", 0)
-                    sign = "🟢" if change >= 0 else "🔴"
-                    parts.append(f"  {sign} {coin.title()}: ${usd:,.2f} ({change:+.1f}%)")
-
-        if prefs.get("fiat") and cache_data.get("fiat"):
-            fiat = cache_data["fiat"]
-            rates = fiat.get("rates", {})
-            parts.append(f"\n💱 <b>Курсы к рублю</b> ({fiat.get('date', 'N/A')}):")
-            for code, name in [("USD", "🇺🇸 Доллар"), ("EUR", "🇪🇺 Евро"), ("CNY", "🇨🇳 Юань")]:
-                val = rates.get(code)
-                parts.append(f"  {name}: {val} ₽" if val else f"  {name}: недоступно")
-
-        if self.news_digest:
-            news_parts = []
-            news_category_map = {
-                "news_top": ("top", "📰 Главное"),
-                "news_world": ("world", "🌍 В мире"),
-                "news_technology": ("technology", "💻 Технологии"),
-                "news_business": ("business", "💼 Бизнес"),
-                "news_science": ("science", "🔬 Наука"),
-                "news_health": ("health", "🏥 Здоровье"),
-                "news_sports": ("sports", "⚽ Спорт"),
-                "news_entertainment": ("entertainment", "🎬 Развлечения"),
-                "news_politics": ("politics", "🏛️ Политика"),
-            }
-            for pref_key, (api_category, label) in news_category_map.items():
-                if prefs.get(pref_key):
-                    articles = self.news_digest.get_cached_articles(
-                        language="ru", category=api_category, max_items=2
-                    )
-                    if articles:
-                        news_parts.append(f"\n{label}:")
-                        for item in articles:
-                            raw_title = item.get("title", "Без заголовка")
-                            title = html.escape((raw_title[:50] + "...") if len(raw_title) > 50 else raw_title)
-                            link = item.get("url", "#")
-                            news_parts.append(f" • <a href='{link}'>{title}</a>")
-
-            if prefs.get("news_all") and not news_parts:
-                combined = self.news_digest.get_combined_digest(max_per_category=2)
-                lines = combined.split("\n")
-                if lines and "Новости дня" in lines[0]:
-                    lines = lines[1:]
-                news_parts = ["\n📊 " + line for line in lines if line.strip()]
-
-            if news_parts:
-                parts.append("\n📰 <b>Новости:</b>")
-                parts.extend(news_parts)
-            elif any(prefs.get(k) for k in NEWS_CATS_CONFIG.keys()):
-                parts.append("\n📰 <b>Новости:</b> временно недоступно")
-
-        parts.append(f"\n\n{PREMIUM_PROMO_TEXT}")
-        return "\n".join(parts)
+    def _format_digest_cached(self, cache_data: dict, prefs: dict, city: str) -> str:
+        """Мемоизированный рендер дайджеста.
+
+        Пользователи с одинаковыми (город, настройки) при неизменных данных
+        получают один и тот же текст — форматируем его один раз. Поколение
+        кэша в ключе гарантирует, что свежие данные не отдадут старый текст.
+        """
+        now_str = datetime.now(_MSK).strftime('%d.%m %H:%M')
+        key = (city, frozenset(prefs.items()), cache_data.get("generation"), now_str)
+        text = self._digest_memo.get(key)
+        if text is None:
+            text = self._format_digest(cache_data, prefs, city, now_str)
+            self._digest_memo[key] = text
+        return text
+
+    def _format_digest(self, cache_data: dict, prefs: dict, city: str,
+                       now_str: Optional[str] = None) -> str:
+        # Чистая CPU-функция без await: в рассылке выполняется в
+        # _format_pool, чтобы не держать event loop на каждом пользователе.
+        # now_str передаёт рассылка — метка одна на весь прогон.
+        current_time = now_str or datetime.now(_MSK).strftime('%d.%m %H:%M')
+        return "\n".join(filter(None, [
+            f"🗞 <b>ИнфоХаб</b> • {current_time} MSK • {city.title().translate(_HTML_ESCAPE)}",
+            self._weather_section(cache_data, prefs),
+            self._crypto_section(cache_data, prefs),
+            self._fiat_section(cache_data, prefs),
+            self._news_section(prefs),
+            f"\n\n{PREMIUM_PROMO_TEXT}",
+        ]))
+
+    @staticmethod
+    def _weather_section(cache_data: dict, prefs: dict) -> str:
+        if not prefs.get("weather"):
+            return ""
+        w = cache_data.get("weather")
+        if not w:
+            return "\n🌡️ <b>Погода:</b> временно недоступно"
+        temp = w.get('temperature', 'N/A')
+        condition = w.get('condition', 'Неизвестно')
+        emoji = w.get('condition_emoji', '🌡️')
+        precip_type = w.get('precipitation_type')
+        cloud_cover = w.get('cloud_cover', 0)
+        precip_str = f", {precip_type}" if precip_type else (", без осадков" if cloud_cover < 20 else "")
+        return f"\n{emoji} <b>Погода:</b> {temp}°C, {condition}{precip_str}"
+
+    @staticmethod
+    def _crypto_section(cache_data: dict, prefs: dict) -> str:
+        crypto = cache_data.get("crypto")
+        if not (prefs.get("crypto") and crypto):
+            return ""
+        lines = ["\n💰 <b>Крипто:</b>"]
+        for coin in ["bitcoin", "ethereum", "tether"]:
+            if coin in crypto:
+                c = crypto[coin]
+                usd = c.get("usd", 0)
+                change = c.get("usd_24h_change", 0)
+                sign = "🟢" if change >= 0 else "🔴"
+                lines.append(f"  {sign} {coin.title()}: ${usd:,.2f} ({change:+.1f}%)")
+        return "\n".join(lines)
+
+    @staticmethod
+    def _fiat_section(cache_data: dict, prefs: dict) -> str:
+        fiat = cache_data.get("fiat")
+        if not (prefs.get("fiat") and fiat):
+            return ""
+        rates = fiat.get("rates", {})
+        lines = [f"\n💱 <b>Курсы к рублю</b> ({fiat.get('date', 'N/A')}):"]
+        for code, name in _FIAT_LABELS:
+            val = rates.get(code)
+            lines.append(f"  {name}: {val} ₽" if val else f"  {name}: недоступно")
+        return "\n".join(lines)
+
+    def _news_section(self, prefs: dict) -> str:
+        if not self.news_digest:
+            return ""
+        news_parts = []
+        for pref_key, api_category, label in _NEWS_CATEGORY_MAP:
+            if prefs.get(pref_key):
+                articles = self.news_digest.get_cached_articles(
+                    language="ru", category=api_category, max_items=2
+                )
+                if articles:
+                    news_parts.append(f"\n{label}:")
+                    for item in articles:
+                        raw_title = item.get("title", "Без заголовка")
+                        title = ((raw_title[:50] + "...") if len(raw_title) > 50 else raw_title).translate(_HTML_ESCAPE)
+                        link = item.get("url", "#")
+                        news_parts.append(f" • <a href='{link}'>{title}</a>")
+
+        if prefs.get("news_all") and not news_parts:
+            combined = self.news_digest.get_combined_digest(max_per_category=2)
+            lines = combined.split("\n")
+            if lines and "Новости дня" in lines[0]:
+                lines = lines[1:]
+            news_parts = ["\n📊 " + line for line in lines if line.strip()]
+
+        if news_parts:
+            return "\n".join(["\n📰 <b>Новости:</b>", *news_parts])
+        if any(prefs.get(k) for k in NEWS_CATS_CONFIG.keys()):
+            return "\n📰 <b>Новости:</b> временно недоступно"
+        return ""
 
     # === BROADCAST ===
+    async def _pace_broadcast(self) -> None:
+        """Выдерживает глобальный темп BROADCAST_RATE_PER_SEC msg/s.
+
+        Каждый потребитель забирает слот отправки под локом и спит до
+        него: суммарный поток не превышает лимит Telegram независимо от
+        числа потребителей и латентности сети.
+        """
+        async with self._pace_lock:
+            now = time.monotonic()
+            slot = max(now, self._next_send_at)
+            self._next_send_at = slot + 1.0 / BROADCAST_RATE_PER_SEC
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def _flood_wait(self, retry_after: float) -> None:
+        """Пауза по требованию Telegram (429) — тормозит все потребители"""
+        async with self._pace_lock:
+            self._next_send_at = max(
+                self._next_send_at, time.monotonic() + retry_after
+            )
+        await asyncio.sleep(retry_after)
+
+    async def _mark_blocked_quiet(self, user_id: int) -> None:
+        """Помечает блокировку в БД — следующие рассылки не тратят
+        send_message на заведомо недоставляемых получателей."""
+        logger.debug("User %s blocked bot", user_id)
+        try:
+            await self.db.mark_blocked(user_id)
+        except Exception as db_err:
+            logger.warning("Не удалось пометить блокировку %s: %s", user_id, db_err)
+
+    async def _broadcast_send_one(self, user_id: int, send_kwargs: dict,
+                                  counters: Dict[str, int]) -> None:
+        """Отправка готового текста одному пользователю."""
+        try:
+            await self._pace_broadcast()
+            try:
+                await self.bot.send_message(chat_id=user_id, **send_kwargs)
+            except TelegramRetryAfter as e:
+                # Flood wait: ждём сколько просит Telegram и повторяем
+                # один раз — дайджест не теряется из-за пикового 429
+                logger.warning(
+                    "⏳ Flood wait %s c при рассылке (user %s)",
+                    e.retry_after, user_id,
+                )
+                await self._flood_wait(e.retry_after)
+                await self.bot.send_message(chat_id=user_id, **send_kwargs)
+            counters["sent"] += 1
+        # aiogram 3 маппит «bot was blocked by the user» (HTTP 403) в
+        # TelegramForbiddenError; ветка по TelegramBadRequest оставлена
+        # на случай нестандартных 400 с тем же текстом
+        except TelegramForbiddenError:
+            await self._mark_blocked_quiet(user_id)
+            counters["failed"] += 1
+        except TelegramBadRequest as e:
+            if "bot was blocked" in str(e).lower():
+                await self._mark_blocked_quiet(user_id)
+            else:
+                logger.warning("Telegram error %s: %s", user_id, e)
+            counters["failed"] += 1
+        except Exception as e:
+            logger.error("Ошибка %s: %s", user_id, e)
+            counters["failed"] += 1
+        # Прогресс — раз на ~1000 пользователей, не на каждого
+        done = counters["sent"] + counters["failed"]
+        if done % 1000 == 0:
+            logger.info("📬 Прогресс рассылки: %d/%d", done, counters["total"])
+
+    async def _broadcast_consumer(self, queue: asyncio.Queue,
+                                  counters: Dict[str, int]) -> None:
+        """Потребитель очереди рассылки: шлёт задания до отмены."""
+        while True:
+            user_id, send_kwargs = await queue.get()
+            try:
+                if not self._shutdown_requested:
+                    await self._broadcast_send_one(user_id, send_kwargs, counters)
+            finally:
+                queue.task_done()
+
     async def hourly_broadcast(self, hour: int):
-        logger.info(f"🚀 Запуск рассылки {hour:02d}:00")
+        logger.info("🚀 Запуск рассылки %02d:00", hour)
         try:
             await self.cache_manager.force_refresh()
-            users = await self.db.get_users_by_broadcast_hour(hour)
-            logger.info(f"📬 Рассылка {len(users)} пользователям ({hour:02d}:00)")
-            sent = failed = 0
-            for user in users:
-                if self._shutdown_requested:
-                    break
-                try:
-                    user_city = user.get("city", "москва")
-                    lat, lon = CITY_COORDINATES.get(user_city, (DEFAULT_LAT, DEFAULT_LON))
-                    user_data = await self.cache_manager.get_data(lat, lon)
-                    msg_text = await self._format_digest(user_data, user["preferences"], user_city)
-                    await self.bot.send_message(
-                        chat_id=user["user_id"], text=msg_text,
-                        parse_mode="HTML", disable_web_page_preview=True
-                    )
-                    sent += 1
-                    await asyncio.sleep(0.05)
-                except TelegramBadRequest as e:
-                    if "bot was blocked" in str(e).lower():
-                        logger.debug(f"User {user['user_id']} blocked bot")
-                    else:
-                        logger.warning(f"Telegram error {user['user_id']}: {e}")
-                    failed += 1
-                except Exception as e:
-                    logger.error(f"Ошибка {user['user_id']}: {e}")
-                    failed += 1
-            logger.info(f"✅ Рассылка {hour:02d}:00: {sent} доставлено, {failed} ошибок")
+            logger.info("📬 Рассылка (%02d:00) — стриминг получателей из БД", hour)
+            # Конвейер producer/consumer: продюсер стримит пользователей из
+            # БД пачками (весь список не материализуется), форматирует
+            # дайджесты, BROADCAST_CONCURRENCY потребителей разбирают
+            # очередь отправки; maxsize даёт естественный backpressure.
+            counters = {"sent": 0, "failed": 0, "total": 0}
+            broadcast_ts = datetime.now(_MSK).strftime('%d.%m %H:%M')
+            # Мемо на весь прогон: данные кэша — один раз на город, текст —
+            # один раз на (город, настройки); группы могут повторяться
+            # между пачками, поэтому кэшируем готовые send_kwargs.
+            data_by_city: Dict[str, dict] = {}
+            rendered: Dict[Any, dict] = {}
+            queue: asyncio.Queue = asyncio.Queue(maxsize=BROADCAST_QUEUE_MAXSIZE)
+            consumers = [
+                asyncio.create_task(self._broadcast_consumer(queue, counters))
+                for _ in range(BROADCAST_CONCURRENCY)
+            ]
+            loop = asyncio.get_running_loop()
+            try:
+                async for batch in self.db.iter_users_by_broadcast_hour(hour):
+                    if self._shutdown_requested:
+                        break
+                    for u in batch:
+                        if self._shutdown_requested:
+                            break
+                        city = u.get("city") or "москва"
+                        key = (city, frozenset(u["preferences"].items()))
+                        send_kwargs = rendered.get(key)
+                        if send_kwargs is None:
+                            data = data_by_city.get(city)
+                            if data is None:
+                                data = await self.cache_manager.get_data(
+                                    *_coords_for(city)
+                                )
+                                data_by_city[city] = data
+                            text = await loop.run_in_executor(
+                                self._format_pool, self._format_digest,
+                                data, u["preferences"], city, broadcast_ts
+                            )
+                            # Общие параметры отправки — один раз на группу;
+                            # per-user остаётся только chat_id
+                            send_kwargs = {
+                                "text": text,
+                                "parse_mode": "HTML",
+                                "disable_web_page_preview": True,
+                            }
+                            rendered[key] = send_kwargs
+                        counters["total"] += 1
+                        await queue.put((u["user_id"], send_kwargs))
+                await queue.join()
+            finally:
+                for consumer in consumers:
+                    consumer.cancel()
+                await asyncio.gather(*consumers, return_exceptions=True)
+            logger.info(
+                "✅ Рассылка %02d:00: %d доставлено, %d ошибок",
+                hour, counters["sent"], counters["failed"],
+            )
         except Exception as e:
-            logger.error(f"Критическая ошибка рассылки: {e}", exc_info=True)
+            logger.error("Критическая ошибка рассылки: %s", e, exc_info=True)
 
     # === SCHEDULER ===
+    # Планировщик собран на asyncio вместо APScheduler: для шести задач
+    # (три интервальных refresh и рассылки по часам) хватает re-arm-циклов
+    # на sleep, без пула потоков, джиттера триггеров и лишней зависимости.
+    # max_instances=1/coalesce=True получаются бесплатно — следующий запуск
+    # ждёт завершения предыдущего await.
+
+    @staticmethod
+    def _seconds_until_hour_msk(hour: int) -> float:
+        """Секунды до ближайшего hour:00 по Москве"""
+        now = datetime.now(_MSK)
+        target = now.replace(hour=hour, minute=0, second=0, microsecond=0)
+        if target <= now:
+            target += timedelta(days=1)
+        return (target - now).total_seconds()
+
+    async def _run_interval(self, coro_fn, seconds: float, name: str):
+        """Вызывает coro_fn каждые seconds, не допуская наложения запусков"""
+        while not self._shutdown_requested:
+            await asyncio.sleep(seconds)
+            try:
+                await coro_fn()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Ошибка фоновой задачи %s: %s", name, e, exc_info=True)
+
+    async def _run_daily_broadcast(self, hour: int):
+        """Запускает hourly_broadcast каждый день в hour:00 МСК"""
+        while not self._shutdown_requested:
+            await asyncio.sleep(self._seconds_until_hour_msk(hour))
+            try:
+                await self.hourly_broadcast(hour)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Ошибка рассылки %02d:00: %s", hour, e, exc_info=True)
+
     def _setup_scheduler(self):
-        msk_tz = timezone(timedelta(hours=3), name="MSK")
-        self.scheduler = AsyncIOScheduler(timezone=msk_tz)
-        for hour in BROADCAST_HOURS:
-            self.scheduler.add_job(
-                self.hourly_broadcast, trigger="cron", hour=hour, minute=0,
-                id=f"daily_digest_{hour}", misfire_grace_time=3600, kwargs={"hour": hour}
+        self._sched_tasks = [
+            asyncio.create_task(
+                self._run_daily_broadcast(hour), name=f"daily_digest_{hour}"
             )
-        self.scheduler.add_job(
-            lambda: asyncio.run_coroutine_threadsafe(self.cache_manager.force_refresh(), asyncio.get_event_loop()),
-            trigger="interval", minutes=30, id="cache_refresh", misfire_grace_time=300
-        )
+            for hour in BROADCAST_HOURS
+        ]
+        self._sched_tasks.append(asyncio.create_task(
+            self._run_interval(self.cache_manager.force_refresh, 1800, "cache_refresh"),
+            name="cache_refresh",
+        ))
         if self.market_digest:
-            self.scheduler.add_job(
-                lambda: asyncio.run_coroutine_threadsafe(self.market_digest.refresh_all(), asyncio.get_event_loop()),
-                trigger="interval", minutes=5, id="market_digest_refresh", misfire_grace_time=120
-            )
+            self._sched_tasks.append(asyncio.create_task(
+                self._run_interval(self.market_digest.refresh_all, 300, "market_digest_refresh"),
+                name="market_digest_refresh",
+            ))
         if self.news_digest:
-            self.scheduler.add_job(
-                lambda: asyncio.run_coroutine_threadsafe(self.news_digest.refresh_all(), asyncio.get_event_loop()),
-                trigger="interval", hours=1, id="news_digest_refresh", misfire_grace_time=600
-            )
-        self.scheduler.start()
-        logger.info(f"📅 Планировщик запущен ({BROADCAST_HOURS})")
+            self._sched_tasks.append(asyncio.create_task(
+                self._run_interval(self.news_digest.refresh_all, 3600, "news_digest_refresh"),
+                name="news_digest_refresh",
+            ))
+        logger.info("📅 Планировщик запущен (%s)", BROADCAST_HOURS)
 
     # === LIFECYCLE ===
     async def on_startup(self):
@@ -785,23 +1104,38 @@ class BotApp:
         logger.info("✅ HTTP-сессия готова")
 
         self.cache_manager = CacheManager(CACHE_PATH, self.api_client)
-        await self.cache_manager.force_refresh()
-        logger.info("✅ Кэш обновлён")
-
         self.market_digest = MarketDigest(MARKET_CACHE_PATH)
-        await self.market_digest.refresh_all()
-        logger.info("✅ Крипто-дайджест готов")
-
         self.news_digest = NewsDigest(NEWS_CACHE_PATH)
-        await self.news_digest.refresh_all()
-        logger.info("✅ NewsDigest инициализирован")
+
+        # Три независимых HTTP-пайплайна прогрева и вызовы Telegram API
+        # идут конкурентно: холодный старт ждёт самый медленный источник,
+        # а не сумму всех
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(self.cache_manager.force_refresh())
+            tg.create_task(self.market_digest.refresh_all())
+            tg.create_task(self.news_digest.refresh_all())
+            # Меню команд — из той же таблицы, что и регистрация
+            tg.create_task(self.bot.set_my_commands([
+                BotCommand(command="start", description="Запуск бота"),
+                *(BotCommand(command=cmd, description=desc)
+                  for cmd, _attr, desc in COMMAND_HANDLERS),
+            ]))
+            me_task = tg.create_task(self.bot.get_me())
+            count_task = tg.create_task(self.db.get_user_count())
+        logger.info("✅ Кэш, дайджесты и меню команд готовы")
 
         self.keyboards = self._create_keyboards()
+        self._format_pool = ThreadPoolExecutor(
+            max_workers=4, thread_name_prefix="digest-format"
+        )
         self._setup_scheduler()
 
-        me = await self.bot.get_me()
-        logger.info(f"✅ Бот: @{me.username} (ID: {me.id})")
-        logger.info(f"📊 Пользователей: {await self.db.get_user_count()}")
+        me = me_task.result()
+        # Username неизменен за жизнь процесса — кэшируем для реферальных
+        # ссылок вместо get_me() на каждое открытие крипто-замка
+        self._bot_username = me.username
+        logger.info("✅ Бот: @%s (ID: %s)", me.username, me.id)
+        logger.info("📊 Пользователей: %s", count_task.result())
         logger.info("=" * 60)
         logger.info("🎯 БОТ ГОТОВ К РАБОТЕ")
         logger.info("=" * 60)
@@ -809,80 +1143,206 @@ class BotApp:
     async def on_shutdown(self):
         logger.info("🛑 Остановка бота...")
         self._shutdown_requested = True
-        if self.scheduler and self.scheduler.running:
-            self.scheduler.shutdown(wait=False)
-        if self.news_digest:
-            await self.news_digest.close()
-        if self.market_digest:
-            await self.market_digest.close()
-        if self.api_client:
-            await self.api_client.close()
-        if self.db:
-            await self.db.close()
+        if self._sched_tasks:
+            for task in self._sched_tasks:
+                task.cancel()
+            await asyncio.gather(*self._sched_tasks, return_exceptions=True)
+            self._sched_tasks = []
+        if self._format_pool:
+            self._format_pool.shutdown(wait=False, cancel_futures=True)
+        # Ресурсы закрываются конкурентно с общим таймаутом: зависший
+        # TLS-close одного соединения не задерживает остановку процесса
+        closers = [
+            service.close()
+            for service in (self.news_digest, self.market_digest,
+                            self.api_client, self.db)
+            if service
+        ]
         if self.bot and self.bot.session:
-            await self.bot.session.close()
+            closers.append(self.bot.session.close())
+        if closers:
+            try:
+                results = await asyncio.wait_for(
+                    asyncio.gather(*closers, return_exceptions=True),
+                    timeout=5.0,
+                )
+                for res in results:
+                    if isinstance(res, Exception):
+                        logger.warning("Ошибка при закрытии ресурса: %s", res)
+            except asyncio.TimeoutError:
+                logger.warning("⏱️ Закрытие ресурсов прервано по таймауту 5 с")
         logger.info("✅ Бот остановлен")
 
-    def register_handlers(self):
+    def _configure_dispatcher(self):
         self.dp.message(CommandStart())(self.cmd_start)
-        self.dp.message(Command("help"))(self.cmd_help)
-        self.dp.message(Command("ping"))(self.cmd_ping)
-        self.dp.message(Command("stats"))(self.cmd_stats)
-        self.dp.message(Command("api"))(self.cmd_api_metrics)
+        # Остальные команды — данными из COMMAND_HANDLERS (таблицу же
+        # переиспользует set_my_commands в on_startup)
+        for cmd, attr, _desc in COMMAND_HANDLERS:
+            self.dp.message(Command(cmd))(getattr(self, attr))
+        # Глобальные кнопки диспетчеризуются фильтрами aiogram (точное
+        # совпадение текста), минуя общий handle_button; catch-all F.text
+        # остаётся для state-зависимых кнопок и прочего текста.
+        for button_text, handler in self._top_dispatch.items():
+            self.dp.message(F.text == button_text)(handler)
         self.dp.message(F.text)(self.handle_button)
-
-    async def run(self):
-        self.bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
-        self.dp = Dispatcher()
-        self.register_handlers()
+        # Набор типов апдейтов неизменен после регистрации — считаем
+        # один раз, а не обходим реестр обработчиков при каждом запуске
+        self._allowed_updates = self.dp.resolve_used_update_types()
+        # Хуки жизненного цикла регистрируются здесь же — run() остаётся
+        # минимальной точкой входа
         self.dp.startup.register(self.on_startup)
         self.dp.shutdown.register(self.on_shutdown)
-        logger.info(f'✅ Health-check запущен на 0.0.0.0:{port}')         logger.info("🔄 Запуск polling...")
-        try:
-            port = int(os.environ.get('PORT', 10000))         from aiohttp import web as _web         async def _health(request):             return _web.Response(text='OK')         _app = _web.Application()         _app.router.add_get('/', _health)         _app.router.add_get('/health', _health)         runner = _web.AppRunner(_app)         await runner.setup()         site = _web.TCPSite(runner, '0.0.0.0', port)         await site.start()          await self.dp.start_polling(
-                self.bot,
-                allowed_updates=self.dp.resolve_used_update_types()
+
+    def _create_bot_session(self) -> AiohttpSession:
+        """HTTP-сессия бота с расширенным пулом соединений.
+
+        Рассылка держит до BROADCAST_CONCURRENCY запросов в полёте;
+        limit_per_host=100 и keep-alive позволяют мультиплексировать их
+        по тёплым сокетам без TLS-рукопожатия на каждое сообщение.
+        """
+        session_kwargs: Dict[str, Any] = {"limit": 100}
+        if orjson is not None:
+            # orjson ускоряет сериализацию каждого send_message;
+            # без пакета aiogram остаётся на stdlib json
+            session_kwargs["json_loads"] = orjson.loads
+            session_kwargs["json_dumps"] = lambda v: orjson.dumps(v).decode("utf-8")
+        session = AiohttpSession(**session_kwargs)
+        connector_init = getattr(session, "_connector_init", None)
+        if connector_init is not None:
+            connector_init.update(
+                limit_per_host=100,
+                ttl_dns_cache=300,
+                # Держим сокеты к api.telegram.org тёплыми между рассылками
+                keepalive_timeout=75,
+                enable_cleanup_closed=True,
             )
+        return session
+
+    async def run(self):
+        try:
+            # Стек гарантирует порядок teardown (LIFO: web-сервер,
+            # затем сессия бота) и не глотает ошибки close, как это
+            # делал бы ручной finally
+            async with AsyncExitStack() as stack:
+                stack.push_async_callback(self.bot.session.close)
+                await self._serve(stack)
         except KeyboardInterrupt:
             logger.info("⚠️ Ctrl+C")
-        except Exception as e:
-            logger.critical(f"🛑 КРИТИЧЕСКАЯ ОШИБКА: {e}")
-            logger.critical(traceback.format_exc())
+        except Exception:
+            # exc_info даёт traceback из sys.exc_info() одной записью —
+            # без ручного traceback.format_exc и второго лог-вызова
+            logger.critical("🛑 КРИТИЧЕСКАЯ ОШИБКА", exc_info=True)
             raise
         finally:
-            if self.bot and self.bot.session:
-                await self.bot.session.close()
             logger.info("🏁 Скрипт завершён")
 
+    async def _serve(self, stack: AsyncExitStack):
+        """Поднимает web-приложение и принимает апдейты до остановки."""
+        port = int(os.environ.get('PORT', 10000))
+        # Публичный URL (например https://infohub.onrender.com):
+        # если задан — Telegram сам пушит апдейты, без затрат
+        # на постоянные getUpdates-запросы; иначе — обычный polling.
+        webhook_base = os.environ.get('WEBHOOK_URL', '').rstrip('/')
+        from aiohttp import web as _web
+
+        async def _health(request):
+            return _web.Response(text='OK')
+
+        _app = _web.Application()
+        _app.router.add_get('/', _health)
+        _app.router.add_get('/health', _health)
+        if webhook_base:
+            from aiogram.webhook.aiohttp_server import (
+                SimpleRequestHandler, setup_application
+            )
+            SimpleRequestHandler(dispatcher=self.dp, bot=self.bot).register(
+                _app, path=WEBHOOK_PATH
+            )
+            setup_application(_app, self.dp, bot=self.bot)
+        runner = _web.AppRunner(_app)
+        await runner.setup()
+        stack.push_async_callback(runner.cleanup)
+        site = _web.TCPSite(runner, '0.0.0.0', port)
+        await site.start()
+        logger.info("✅ Health-check запущен на 0.0.0.0:%s", port)
+        if webhook_base:
+            await self.bot.set_webhook(
+                webhook_base + WEBHOOK_PATH,
+                allowed_updates=self._allowed_updates
+            )
+            logger.info("🔄 Webhook установлен: %s%s", webhook_base, WEBHOOK_PATH)
+            # SIGTERM от systemd/docker должен завершать процесс так же
+            # аккуратно, как Ctrl+C: будим ожидание и даём стеку
+            # закрыть сессию вместо жёсткого RST
+            stop_event = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            for sig in (signal.SIGTERM, signal.SIGINT):
+                try:
+                    loop.add_signal_handler(sig, stop_event.set)
+                except NotImplementedError:  # Windows
+                    pass
+            await stop_event.wait()
+            logger.info("🛑 Получен сигнал остановки")
+        else:
+            await self.bot.delete_webhook()
+            logger.info("🔄 Запуск polling...")
+            # handle_signals=True: aiogram сам останавливает polling
+            # по SIGTERM/SIGINT и прогоняет shutdown-хуки
+            # polling_timeout=30: getUpdates держится открытым до 30 с —
+            # в простое почти нет запросов к API. close_bot_session=False:
+            # сессию закрывает AsyncExitStack в run().
+            await self.dp.start_polling(
+                self.bot,
+                polling_timeout=30,
+                allowed_updates=self._allowed_updates,
+                handle_signals=True,
+                close_bot_session=False,
+            )
+
 
 def check_critical_files():
-    logger.info("🔍 Проверка файловой системы...")
-    try:
-        test_file = Path(__file__).parent / ".write_test"
-        test_file.write_text("test")
-        test_file.unlink()
-        logger.info("✅ Права на запись: OK")
-    except (IOError, OSError, PermissionError) as e:
-        logger.warning(f"⚠️ Права ограничены: {e}")
-    logger.info(f"{'✅' if DB_PATH.exists() else '📝'} DB: {DB_PATH}")
-    logger.info(f"{'✅' if CACHE_PATH.exists() else '📝'} Cache: {CACHE_PATH}")
-    logger.info(f"{'✅' if MARKET_CACHE_PATH.exists() else '📝'} Market: {MARKET_CACHE_PATH}")
-    logger.info(f"{'✅' if NEWS_CACHE_PATH.exists() else '📝'} News: {NEWS_CACHE_PATH}")
+    # Весь отчёт — одной записью лога: один захват хендлера и один
+    # write вместо шести
+    lines = ["🔍 Проверка файловой системы..."]
+    # os.access — один системный вызов без записи на диск,
+    # вместо пробного файла write+unlink
+    if os.access(Path(__file__).parent, os.W_OK):
+        lines.append("✅ Права на запись: OK")
+    else:
+        lines.append("⚠️ Права на запись ограничены")
+    # Один scandir на каталог вместо stat() на каждый путь
+    names_by_parent: Dict[Path, set] = {}
+
+    def _exists(p: Path) -> bool:
+        parent = p.parent
+        if parent not in names_by_parent:
+            try:
+                names_by_parent[parent] = {e.name for e in os.scandir(parent)}
+            except OSError:
+                names_by_parent[parent] = set()
+        return p.name in names_by_parent[parent]
+
+    for label, p in PATH_LABELS:
+        lines.append(f"{'✅' if _exists(p) else '📝'} {label}: {p}")
+    logger.info("\n".join(lines))
 
 
 def main():
     logger.info("📍 Точка входа")
+    try:
+        import uvloop
+        uvloop.install()
+        logger.info("⚡ uvloop активирован")
+    except ImportError:
+        pass  # стандартный event loop — uvloop необязателен
     try:
         check_critical_files()
         app = BotApp()
         asyncio.run(app.run())
-    except SystemExit as e:
-        sys.exit(e.code)
     except KeyboardInterrupt:
         sys.exit(0)
-    except Exception as e:
-        logger.critical(f"🛑 {e}")
-        logger.critical(traceback.format_exc())
+    except Exception:
+        logger.critical("🛑 Фатальная ошибка", exc_info=True)
         sys.exit(1)
 
 
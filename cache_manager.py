@@ -20,6 +20,10 @@ class CacheManager:
         self.api_client = api_client
         self._refresh_lock = asyncio.Lock()
         self._bg_task: Optional[asyncio.Task] = None
+        # Поколение кэша: растёт при каждом обновлении данных. Потребители
+        # (мемоизация дайджеста в bot.py) используют его в ключе кэша —
+        # новые данные автоматически инвалидируют старые записи.
+        self._generation = 0
 
     def _is_cache_valid(self, cache_item: Dict) -> bool:
         if not cache_item or "fetched_at" not in cache_item:
@@ -81,6 +85,7 @@ class CacheManager:
         if global_valid and weather_valid:
             result = global_data.copy()
             result["weather"] = weather_data.get("data")
+            result["generation"] = self._generation
             return result
 
         # Если что-то устарело и включен фон — запускаем обновление, отдаем старое
@@ -92,6 +97,7 @@ class CacheManager:
             # Собираем ответ из того, что есть
             result = global_data.copy()
             result["weather"] = weather_data.get("data")
+            result["generation"] = self._generation
             return result
 
         # Если кэш совсем пустой — блокируемся и ждём
@@ -103,6 +109,7 @@ class CacheManager:
             if self._is_cache_valid(global_data) and self._is_cache_valid(weather_data):
                 result = global_data.copy()
                 result["weather"] = weather_data.get("data")
+                result["generation"] = self._generation
                 return result
                 
             return await self._refresh_cache(lat, lon, not self._is_cache_valid(global_data), not self._is_cache_valid(weather_data))
@@ -130,10 +137,12 @@ class CacheManager:
                 logger.error(f"Ошибка фонового обновления глобальных данных: {e}")
 
         await self._save_cache(full_cache)
+        self._generation += 1
 
         # Собираем итоговый ответ для юзера, который вызвал обновление
         result = full_cache.get("global", {}).copy()
         result["weather"] = full_cache.get(coord_key, {}).get("data")
+        result["generation"] = self._generation
         return result
 
     async def force_refresh(self, lat: float = DEFAULT_LAT, lon: float = DEFAULT_LON):
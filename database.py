@@ -69,6 +69,7 @@ class Database:
             (3, self._migrate_v3),
             (4, self._migrate_v4),
             (5, self._migrate_v5),
+            (6, self._migrate_v6),
         ]
         for version, fn in migrations:
             if current_version < version:
@@ -151,6 +152,20 @@ class Database:
             pass
         logger.debug("Database: v5 — added last_state column")
 
+    async def _migrate_v6(self, db) -> None:
+        """Миграция v6: метка блокировки бота пользователем.
+
+        Заблокировавшие бот получатели исключаются из выборок рассылки —
+        без этого каждый из них стоил бы по одному обречённому
+        send_message в час. Сбрасывается при повторном /start.
+        """
+        try:
+            await db.execute("ALTER TABLE users ADD COLUMN blocked_at TIMESTAMP")
+        except Exception:
+            pass
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_users_blocked ON users(blocked_at)")
+        logger.debug("Database: v6 — added blocked_at column")
+
     # === ВСПОМОГАТЕЛЬНЫЕ ===
 
     @staticmethod
@@ -201,7 +216,8 @@ class Database:
             ON CONFLICT(user_id) DO UPDATE SET
                 username = excluded.username,
                 first_name = excluded.first_name,
-                city = excluded.city
+                city = excluded.city,
+                blocked_at = NULL
         """, (user_id, username, first_name, city))
 
         await self._conn.executemany(
@@ -231,6 +247,39 @@ class Database:
         await self._conn.commit()
         logger.info(f"User {user_id}: {category} set to {enabled}")
 
+    async def toggle_and_fetch(self, user_id: int, category: str, enabled: bool) -> tuple:
+        """Переключение категории и чтение актуальных настроек одной транзакцией.
+
+        Настройки нужны сразу после toggle для перерисовки клавиатуры —
+        объединение записи и чтения убирает лишние round-trip'ы и commit.
+        Возвращает (preferences, broadcast_hour).
+        """
+        if category not in CATEGORIES:
+            raise ValueError(f"Неизвестная категория: {category}")
+        await self._conn.execute("""
+            INSERT INTO preferences (user_id, category, is_enabled)
+            VALUES (?, ?, ?)
+            ON CONFLICT(user_id, category) DO UPDATE SET is_enabled = excluded.is_enabled
+        """, (user_id, category, 1 if enabled else 0))
+        cursor = await self._conn.execute("""
+            SELECT u.broadcast_hour, p.category, p.is_enabled
+            FROM users u
+            LEFT JOIN preferences p ON u.user_id = p.user_id
+            WHERE u.user_id = ?
+        """, (user_id,))
+        rows = await cursor.fetchall()
+        await self._conn.commit()
+
+        prefs = {cat: True for cat in CATEGORIES}
+        hour = 9
+        if rows:
+            hour = rows[0][0] if rows[0][0] else 9
+            for row in rows:
+                if row[1] and row[1] in CATEGORIES:
+                    prefs[row[1]] = bool(row[2])
+        logger.info(f"User {user_id}: {category} set to {enabled}")
+        return prefs, hour
+
     async def get_user_preferences(self, user_id: int) -> Dict[str, bool]:
         cursor = await self._conn.execute(
             "SELECT category, is_enabled FROM preferences WHERE user_id = ?", (user_id,)
@@ -286,6 +335,34 @@ class Database:
         )
         await self._conn.commit()
 
+    async def get_user_context(self, user_id: int) -> tuple:
+        """Состояние, настройки, час рассылки и город — одним запросом.
+
+        Заменяет 3-4 отдельных SELECT на горячем пути обработчиков кнопок.
+        Возвращает (state, preferences, broadcast_hour, city) с теми же
+        значениями по умолчанию, что и одиночные геттеры.
+        """
+        cursor = await self._conn.execute("""
+            SELECT u.last_state, u.broadcast_hour, u.city, p.category, p.is_enabled
+            FROM users u
+            LEFT JOIN preferences p ON u.user_id = p.user_id
+            WHERE u.user_id = ?
+        """, (user_id,))
+        rows = await cursor.fetchall()
+
+        prefs = {cat: True for cat in CATEGORIES}
+        if not rows:
+            return "main", prefs, 9, "москва"
+
+        first = rows[0]
+        state = first[0] if first[0] in VALID_STATES else "main"
+        hour = first[1] if first[1] else 9
+        city = first[2] if first[2] else "москва"
+        for row in rows:
+            if row[3] and row[3] in CATEGORIES:
+                prefs[row[3]] = bool(row[4])
+        return state, prefs, hour, city
+
     # === БРОАДКАСТ ===
 
     async def _fetch_users(self, where_clause: str = "", params: tuple = ()) -> List[Dict]:
@@ -319,11 +396,64 @@ class Database:
                 users_map[uid]["preferences"][row[5]] = bool(row[6])
         return list(users_map.values())
 
+    async def mark_blocked(self, user_id: int) -> None:
+        """Помечает пользователя, заблокировавшего бота."""
+        await self._conn.execute(
+            "UPDATE users SET blocked_at = CURRENT_TIMESTAMP WHERE user_id = ?",
+            (user_id,)
+        )
+        await self._conn.commit()
+        logger.info(f"User {user_id}: marked as blocked")
+
     async def get_all_active_users(self) -> List[Dict]:
-        return await self._fetch_users()
+        return await self._fetch_users("u.blocked_at IS NULL")
 
     async def get_users_by_broadcast_hour(self, hour: int) -> List[Dict]:
-        return await self._fetch_users("u.broadcast_hour = ?", (hour,))
+        return await self._fetch_users(
+            "u.broadcast_hour = ? AND u.blocked_at IS NULL", (hour,)
+        )
+
+    async def iter_users_by_broadcast_hour(self, hour: int, batch: int = 500):
+        """Стримит получателей рассылки пачками по `batch` пользователей.
+
+        В отличие от get_users_by_broadcast_hour не материализует весь
+        список в памяти: отправка может начинаться с первой пачки, пока
+        курсор дочитывает остальных. ORDER BY u.user_id гарантирует, что
+        строки JOIN одного пользователя идут подряд.
+        """
+        cursor = await self._conn.execute("""
+            SELECT u.user_id, u.username, u.first_name, u.city, u.is_premium,
+                   p.category, p.is_enabled
+            FROM users u
+            LEFT JOIN preferences p ON u.user_id = p.user_id
+            WHERE u.broadcast_hour = ? AND u.blocked_at IS NULL
+            ORDER BY u.user_id
+        """, (hour,))
+
+        chunk: List[Dict] = []
+        current: Optional[Dict] = None
+        async for row in cursor:
+            uid = row[0]
+            if current is None or uid != current["user_id"]:
+                if current is not None:
+                    chunk.append(current)
+                    if len(chunk) >= batch:
+                        yield chunk
+                        chunk = []
+                current = {
+                    "user_id": uid,
+                    "username": row[1],
+                    "first_name": row[2],
+                    "city": row[3],
+                    "is_premium": bool(row[4]),
+                    "preferences": {cat: True for cat in CATEGORIES}
+                }
+            if row[5]:
+                current["preferences"][row[5]] = bool(row[6])
+        if current is not None:
+            chunk.append(current)
+        if chunk:
+            yield chunk
 
     # === РЕФЕРАЛЬНАЯ СИСТЕМА ===
 
@@ -75,6 +75,9 @@ class MarketDigest:
         self._cache: Dict[str, CacheEntry] = {}
         self._session: Optional[aiohttp.ClientSession] = None
         self._lock = asyncio.Lock()
+        # Защита refresh_all от наложения: затянувшееся обновление не
+        # должно порождать второй параллельный прогон по тем же API
+        self._refresh_lock = asyncio.Lock()
         self._metrics = APIMetrics()
         
         # Загружаем кэш из файла при инициализации
@@ -335,27 +338,34 @@ class MarketDigest:
         Returns:
             Dict[str, bool]: Статус обновления каждого источника
         """
-        logger.info("MarketDigest: Starting full refresh")
-        
-        results = {}
-        
-        # Запускаем параллельно (но с учётом лимитов)
-        trending_task = asyncio.create_task(self.get_trending())
-        global_task = asyncio.create_task(self.get_global())
-        fng_task = asyncio.create_task(self.get_fng())
-        
-        trending, global_data, fng = await asyncio.gather(
-            trending_task, global_task, fng_task, return_exceptions=True
-        )
-        
-        results["trending"] = trending is not None and not isinstance(trending, Exception)
-        results["global"] = global_data is not None and not isinstance(global_data, Exception)
-        results["fng"] = fng is not None and not isinstance(fng, Exception)
-        
-        success = sum(results.values())
-        logger.info(f"MarketDigest: Refresh complete ({success}/3 sources)")
-        
-        return results
+        # asyncio не вытесняет задачи — наложение возможно только между
+        # await; явная проверка блокировки отсекает повторный запуск
+        if self._refresh_lock.locked():
+            logger.info("MarketDigest: Refresh already in progress, skipping")
+            return {}
+
+        async with self._refresh_lock:
+            logger.info("MarketDigest: Starting full refresh")
+
+            results = {}
+
+            # Запускаем параллельно (но с учётом лимитов)
+            trending_task = asyncio.create_task(self.get_trending())
+            global_task = asyncio.create_task(self.get_global())
+            fng_task = asyncio.create_task(self.get_fng())
+
+            trending, global_data, fng = await asyncio.gather(
+                trending_task, global_task, fng_task, return_exceptions=True
+            )
+
+            results["trending"] = trending is not None and not isinstance(trending, Exception)
+            results["global"] = global_data is not None and not isinstance(global_data, Exception)
+            results["fng"] = fng is not None and not isinstance(fng, Exception)
+
+            success = sum(results.values())
+            logger.info(f"MarketDigest: Refresh complete ({success}/3 sources)")
+
+            return results
 
     # === ФОРМАТИРОВАНИЕ ДАЙДЖЕСТА ===
     
@@ -281,7 +281,9 @@ async def test_bot_structure():
         print("✅ BotApp создан")
         
         # Проверяем инициализацию атрибутов
-        assert app.bot is None, "bot должен быть None до инициализации"
+        # bot/dp создаются сразу в __init__, сервисы — в on_startup
+        assert app.bot is not None, "bot создаётся в __init__"
+        assert app.dp is not None, "dp создаётся в __init__"
         assert app.db is None, "db должен быть None до инициализации"
         assert app.api_client is None, "api_client должен быть None до инициализации"
         print("✅ Атрибуты инициализированы правильно")
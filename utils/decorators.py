@@ -4,13 +4,14 @@
 import asyncio
 import logging
 import time
-from collections import defaultdict
+from collections import Counter
 from functools import wraps
 from typing import Any, Callable
 
 from aiogram import BaseMiddleware
 from aiogram.exceptions import TelegramBadRequest
 from aiogram.types import Message, TelegramObject
+from cachetools import TTLCache
 
 logger = logging.getLogger(__name__)
 
@@ -30,7 +31,10 @@ class RateLimitMiddleware(BaseMiddleware):
         """
         super().__init__()
         self.rate_limit_seconds = rate_limit_seconds
-        self._user_last_request: defaultdict[int, float] = defaultdict(float)
+        # TTLCache вместо defaultdict: метки неактивных пользователей
+        # выселяются через час, память ограничена O(активных), а не
+        # O(всех когда-либо писавших)
+        self._user_last_request: TTLCache = TTLCache(maxsize=100_000, ttl=3600)
 
     async def __call__(
         self,
@@ -51,7 +55,7 @@ class RateLimitMiddleware(BaseMiddleware):
             return await handler(event, data)
 
         now = time.monotonic()
-        last = self._user_last_request[user_id]
+        last = self._user_last_request.get(user_id, 0.0)
         elapsed = now - last
 
         if elapsed < self.rate_limit_seconds:
@@ -126,7 +130,9 @@ async def _send_error_message(event: Any, text: str) -> None:
 
 
 # === USAGE STATISTICS ===
-usage_stats: defaultdict[str, int] = defaultdict(int)
+# Counter без блокировок: инкремент int-значения атомарен под GIL,
+# get_usage_stats отдаёт снимок через dict()
+usage_stats: Counter[str] = Counter()
 
 
 def track_usage(action: str) -> Callable: